@@ -0,0 +1,111 @@
+# cbvhtmx\admission.py
+import logging
+import os
+import re
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_plan_rows_pattern = re.compile(r"rows=(\d+)")
+
+
+class FileLockSemaphore:
+    """
+    A host-wide semaphore built from lock files, shared by all worker processes on the host.
+
+    Every slot is a file locked with flock(), so slots held by a crashed worker are released by the operating system.
+    """
+
+    def __init__(self, directory, slots, name="export"):
+        if fcntl is None:
+            raise ImproperlyConfigured(
+                "FileLockSemaphore needs fcntl, use a CacheSemaphore on this platform"
+            )
+        self.directory = directory
+        self.slots = slots
+        self.name = name
+
+    def acquire(self):
+        """
+        Takes a free slot without waiting.
+
+        :return: a token for release() or None if all slots are taken
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in range(self.slots):
+            lock_file = open(
+                os.path.join(self.directory, f"{self.name}-{slot}.lock"), "a+"
+            )
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            return lock_file
+        return None
+
+    def release(self, token):
+        fcntl.flock(token, fcntl.LOCK_UN)
+        token.close()
+
+
+class CacheSemaphore:
+    """
+    A counting semaphore in the Django cache.
+
+    It only works across workers (and hosts) with a shared cache backend such as Redis or Memcached. The counter
+    expires after the timeout, so slots of a crashed worker are eventually freed.
+    """
+
+    def __init__(self, key, slots, cache_alias="default", timeout=600):
+        self.key = key
+        self.slots = slots
+        self.cache = caches[cache_alias]
+        self.timeout = timeout
+
+    def acquire(self):
+        self.cache.add(self.key, 0, self.timeout)
+        try:
+            count = self.cache.incr(self.key)
+        except ValueError:
+            # the counter expired between add() and incr()
+            self.cache.add(self.key, 0, self.timeout)
+            count = self.cache.incr(self.key)
+        if count > self.slots:
+            self.release(True)
+            return None
+        return True
+
+    def release(self, token):
+        try:
+            self.cache.decr(self.key)
+        except ValueError:
+            pass
+
+
+def estimate_row_count(queryset):
+    """
+    Estimates the number of rows of a queryset.
+
+    On PostgreSQL the planner's estimate is read from EXPLAIN, so no rows are counted. Other databases use COUNT().
+
+    :param django.db.models.query.QuerySet queryset: the queryset to estimate
+    :return: int
+    """
+    if connections[queryset.db].vendor == "postgresql":
+        try:
+            match = _plan_rows_pattern.search(queryset.explain())
+        except Exception as explain_e:
+            logger.debug(f"EXPLAIN failed, counting instead: {explain_e}")
+            match = None
+        if match:
+            return int(match.group(1))
+    return queryset.count()
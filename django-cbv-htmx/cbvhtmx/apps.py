@@ -1,6 +1,14 @@
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
+from django.conf import settings
 
 
 class CbvHtmxConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "cbvhtmx"
+
+    def ready(self):
+        from .live import register_live_model
+
+        # models listed here publish their changes in every process, not only after a live view was requested
+        for model_label in getattr(settings, "CBVHTMX_LIVE_MODELS", []):
+            register_live_model(apps.get_model(model_label))
@@ -0,0 +1,157 @@
+# cbvhtmx\live.py
+import asyncio
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_live_models = set()
+
+
+class BaseBroker:
+    """
+    Interface for brokers that deliver model changes to subscribed clients.
+
+    A broker for several nodes (e.g. on top of Redis pub/sub or PostgreSQL LISTEN/NOTIFY) has to implement publish and
+    subscribe. Messages are dictionaries with the keys "model", "pk", "action" ("save" or "delete") and
+    "created". Changes to many objects at once (see publish_changes) carry a list "pks" instead of "pk".
+    """
+
+    def publish(self, channel, message):
+        """
+        Sends a message to all subscribers of a channel. Called from synchronous code (model signals).
+        """
+        raise NotImplementedError("Brokers must implement publish()")
+
+    def subscribe(self, channel):
+        """
+        Returns a subscription object with an async get(timeout) method (returning None on timeout) and a close()
+        method. Called from the event loop that will read the subscription.
+        """
+        raise NotImplementedError("Brokers must implement subscribe()")
+
+
+class InMemorySubscription:
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def put(self, message):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker(BaseBroker):
+    """
+    A broker for a single process. Changes saved in other processes are NOT delivered.
+    """
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.put(message)
+            except RuntimeError:
+                # the subscriber's event loop is already closed
+                subscription.close()
+
+    def subscribe(self, channel):
+        subscription = InMemorySubscription(self, channel)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.get(subscription.channel, set()).discard(subscription)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """
+    Returns the broker configured in the setting CBVHTMX_LIVE_BROKER (dotted path to a BaseBroker subclass).
+    Defaults to the InMemoryBroker.
+    """
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                broker_path = getattr(settings, "CBVHTMX_LIVE_BROKER", None)
+                broker_class = (
+                    import_string(broker_path) if broker_path else InMemoryBroker
+                )
+                _broker = broker_class()
+    return _broker
+
+
+def get_model_channel(model):
+    return f"cbvhtmx:{model._meta.label_lower}"
+
+
+def publish_instance(instance, action, created=False):
+    message = {
+        "model": instance._meta.label_lower,
+        "pk": instance.pk,
+        "action": action,
+        "created": created,
+    }
+    channel = get_model_channel(instance.__class__)
+    transaction.on_commit(lambda: get_broker().publish(channel, message))
+
+
+def publish_changes(model, pks):
+    """
+    Publishes one "save" message for many objects of a registered model, for changes made without signals (e.g.
+    QuerySet.update()). Subscribers read all of them with one query.
+    """
+    if model._meta.label_lower not in _live_models:
+        return
+    channel = get_model_channel(model)
+    message = {
+        "model": model._meta.label_lower,
+        "pks": list(pks),
+        "action": "save",
+        "created": False,
+    }
+    transaction.on_commit(lambda: get_broker().publish(channel, message))
+
+
+def _publish_save(sender, instance, created=False, **kwargs):
+    publish_instance(instance, "save", created=created)
+
+
+def _publish_delete(sender, instance, **kwargs):
+    publish_instance(instance, "delete")
+
+
+def register_live_model(model):
+    """
+    Publishes save/delete signals of a model to the broker. Registering a model twice has no effect.
+    """
+    _live_models.add(model._meta.label_lower)
+    dispatch_uid = f"cbvhtmx_live_{model._meta.label_lower}"
+    post_save.connect(_publish_save, sender=model, dispatch_uid=dispatch_uid)
+    post_delete.connect(_publish_delete, sender=model, dispatch_uid=dispatch_uid)
@@ -0,0 +1,456 @@
+# cbvhtmx\management\commands\index_advisor.py
+import os
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, migrations, models
+from django.db.migrations.loader import MigrationLoader
+from django.db.models.functions import Upper
+from django.db.migrations.writer import MigrationWriter
+from django.urls import URLPattern, URLResolver, get_resolver
+
+from ...mixins import ExportMixin, FieldQueryMixin, OrderingMixin, TagsMixin
+from ...query import TEXT, resolve_field_path
+
+ADVISED_MIXINS = (OrderingMixin, FieldQueryMixin, TagsMixin, ExportMixin)
+
+# lookups which can never use a plain B-tree index
+UNINDEXABLE_LOOKUPS = (
+    "contains",
+    "icontains",
+    "endswith",
+    "iendswith",
+    "regex",
+    "iregex",
+)
+
+# lookups a plain B-tree index can't serve on PostgreSQL (UPPER() or LIKE), mapped to the index that can
+PATTERN_LOOKUPS = {
+    "iexact": "upper",
+    "startswith": "pattern",
+    "istartswith": "upper_pattern",
+}
+
+# vendors whose plain index serves the PATTERN_LOOKUPS (case-insensitive collations)
+PATTERN_INDEX_VENDORS = ("mysql",)
+
+INDEX_SUFFIXES = {
+    "upper": "upp",
+    "pattern": "pat",
+    "upper_pattern": "upt",
+}
+
+
+def iter_view_classes(url_patterns, prefix=""):
+    """
+    Walks a URLconf and yields (route, view class, as_view() arguments) for every class-based view.
+
+    :param list url_patterns: patterns of a URLResolver
+    :param str prefix: the route of the parent resolvers
+    :return: generator of tuples (str, type, dict)
+    """
+    for pattern in url_patterns:
+        route = f"{prefix}{pattern.pattern}"
+        if isinstance(pattern, URLResolver):
+            yield from iter_view_classes(pattern.url_patterns, route)
+        elif isinstance(pattern, URLPattern):
+            view_class = getattr(pattern.callback, "view_class", None)
+            if view_class is not None:
+                view_initkwargs = getattr(pattern.callback, "view_initkwargs", {})
+                yield route, view_class, view_initkwargs
+
+
+def is_indexed(model, field):
+    """
+    Checks if a field is the leading column of any index of its model.
+    """
+    if field.primary_key or getattr(field, "unique", False):
+        return True
+    if getattr(field, "db_index", False):
+        return True
+
+    meta = model._meta
+    leading_fields = [
+        index.fields[0].lstrip("-") for index in meta.indexes if index.fields
+    ]
+    leading_fields += [fields[0] for fields in meta.unique_together if fields]
+    leading_fields += [
+        fields[0] for fields in getattr(meta, "index_together", ()) if fields
+    ]
+    leading_fields += [
+        constraint.fields[0]
+        for constraint in meta.constraints
+        if isinstance(constraint, models.UniqueConstraint) and constraint.fields
+    ]
+    return field.name in leading_fields
+
+
+def get_pattern_opclass(field):
+    return (
+        "text_pattern_ops"
+        if field.get_internal_type() == "TextField"
+        else "varchar_pattern_ops"
+    )
+
+
+def is_same_index(index, other_index):
+    """
+    Checks if two indexes cover the same fields or expressions, whatever their names.
+    """
+    _, args, kwargs = index.deconstruct()
+    _, other_args, other_kwargs = other_index.deconstruct()
+    kwargs.pop("name", None)
+    other_kwargs.pop("name", None)
+    return tuple(args) == tuple(other_args) and kwargs == other_kwargs
+
+
+class Command(BaseCommand):
+    help = (
+        "Finds views using the cbvhtmx mixins and reports ordering, query and export fields that aren't backed by "
+        "a database index."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="Print the EXPLAIN output for every unindexed sort and search path.",
+        )
+        parser.add_argument(
+            "--make-migration",
+            action="store_true",
+            help="Write migrations which add the recommended indexes missing from the migration state.",
+        )
+        parser.add_argument(
+            "--app",
+            action="append",
+            dest="app_labels",
+            default=[],
+            help="Only write migrations for this app (can be used multiple times).",
+        )
+        parser.add_argument(
+            "--database",
+            default="default",
+            help="The database used for EXPLAIN and the migration graph.",
+        )
+
+    def handle(self, *args, **options):
+        self.explain = options["explain"]
+        self.database = options["database"]
+        self.vendor = connections[self.database].vendor
+
+        recommendations = OrderedDict()
+        views_found = 0
+
+        for route, view_class, view_initkwargs in iter_view_classes(
+            get_resolver().url_patterns
+        ):
+            if not issubclass(view_class, ADVISED_MIXINS):
+                continue
+            if view_initkwargs:
+                # attributes passed to as_view(), e.g. TagAutocompleteView.as_view(model=Albums)
+                try:
+                    view_class = type(
+                        view_class.__name__, (view_class,), dict(view_initkwargs)
+                    )
+                except ImproperlyConfigured as view_e:
+                    self.stdout.write(
+                        self.style.ERROR(f"{view_class.__name__} ({route}): {view_e}")
+                    )
+                    continue
+            model = getattr(view_class, "model", None)
+            if model is None:
+                self.stdout.write(
+                    f"{view_class.__name__} ({route}): no model attribute, skipped"
+                )
+                continue
+
+            views_found += 1
+            self.stdout.write(
+                self.style.MIGRATE_HEADING(
+                    f"{view_class.__name__} ({route}) - {model._meta.label}"
+                )
+            )
+            for usage, field_path in self.get_field_paths(view_class):
+                self.check_field_path(model, usage, field_path, recommendations)
+
+        if not views_found:
+            self.stdout.write("No views using the cbvhtmx mixins were found.")
+            return
+
+        if not recommendations:
+            self.stdout.write(
+                self.style.SUCCESS("All sort and search paths are indexed.")
+            )
+            return
+
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(
+                "Recommended indexes (add them to the model's Meta.indexes):"
+            )
+        )
+        for (label, field_name, index_kind), target_model in recommendations.items():
+            field = target_model._meta.get_field(field_name)
+            self.stdout.write(
+                f"  {label}: {self.describe_index(target_model, field, index_kind)},"
+            )
+
+        if options["make_migration"]:
+            self.write_migrations(recommendations, options["app_labels"])
+
+    def get_field_paths(self, view_class):
+        """
+        Collects the field paths declared on a view as tuples (usage, field path).
+        """
+        field_paths = []
+
+        if issubclass(view_class, OrderingMixin):
+            ordering = view_class.ordering or []
+            if isinstance(ordering, str):
+                ordering = [ordering]
+            # users can sort by any of the ordering_fields through ?ordering=
+            if view_class.ordering_fields is not None:
+                ordering_fields = list(view_class.ordering_fields)
+            else:
+                ordering_fields = [
+                    field.name for field in view_class.model._meta.concrete_fields
+                ]
+            ordering_paths = [
+                entry.lstrip("-") for entry in ordering if isinstance(entry, str)
+            ]
+            for field_name in ordering_fields:
+                if field_name not in ordering_paths:
+                    ordering_paths.append(field_name)
+            field_paths += [("ordering", path) for path in ordering_paths]
+
+        if issubclass(view_class, FieldQueryMixin) and view_class.query_fields:
+            try:
+                query_spec = view_class.get_query_spec()
+            except ImproperlyConfigured as spec_e:
+                self.stdout.write(self.style.ERROR(f"  [query] {spec_e}"))
+            else:
+                field_paths += [
+                    (
+                        "query",
+                        (
+                            f"{query_field.path}__{query_field.lookup}"
+                            if query_field.kind == TEXT
+                            else query_field.entry
+                        ),
+                    )
+                    for query_field in query_spec.fields
+                ]
+
+        if issubclass(view_class, TagsMixin) and view_class.tags_field:
+            field_paths.append(
+                ("tags", f"{view_class.tags_field}__{view_class.tag_name_field}")
+            )
+
+        if issubclass(view_class, ExportMixin):
+            field_paths += [
+                ("export", entry.model_field)
+                for entry in view_class.export_fields
+                if getattr(entry, "model_field", None)
+            ]
+
+        return field_paths
+
+    def check_field_path(self, model, usage, field_path, recommendations):
+        try:
+            target_model, field, lookup, _ = resolve_field_path(model, field_path)
+        except FieldDoesNotExist:
+            self.stdout.write(
+                self.style.ERROR(f"  [{usage}] {field_path}: field does not exist")
+            )
+            return
+
+        if not getattr(field, "concrete", False) or field.many_to_many:
+            # relations to many objects are joined through their own (indexed) keys
+            self.stdout.write(f"  [{usage}] {field_path}: relation, joined on keys")
+            return
+
+        lookup_name = lookup.split("__")[-1] if lookup else None
+        index_kind = "btree"
+        if lookup_name in PATTERN_LOOKUPS and self.vendor not in PATTERN_INDEX_VENDORS:
+            index_kind = PATTERN_LOOKUPS[lookup_name]
+
+        if index_kind == "btree" and is_indexed(target_model, field):
+            self.stdout.write(self.style.SUCCESS(f"  [{usage}] {field_path}: indexed"))
+            return
+        if index_kind != "btree" and any(
+            is_same_index(index, self.get_index(target_model, field, index_kind))
+            for index in target_model._meta.indexes
+        ):
+            self.stdout.write(self.style.SUCCESS(f"  [{usage}] {field_path}: indexed"))
+            return
+
+        if usage == "export":
+            # exported columns are only read, never filtered or sorted by
+            self.stdout.write(f"  [{usage}] {field_path}: read only")
+            return
+
+        if self.explain:
+            self.print_explain(model, usage, field_path, lookup)
+
+        if lookup_name in UNINDEXABLE_LOOKUPS:
+            # a B-tree index can't serve these, so none is recommended
+            self.stdout.write(
+                self.style.WARNING(
+                    f"  [{usage}] {field_path}: '{lookup}' scans the table, a B-tree index can't help"
+                )
+            )
+            if self.vendor == "postgresql":
+                self.stdout.write(
+                    f"      a trigram index can (needs the pg_trgm extension): "
+                    f'GinIndex(fields=["{field.name}"], name="{field.name}_trgm", '
+                    f'opclasses=["gin_trgm_ops"]) on {target_model._meta.label}'
+                )
+            return
+
+        if index_kind != "btree" and self.vendor != "postgresql":
+            # e.g. SQLite compiles them to LIKE, which no index serves by default
+            self.stdout.write(
+                self.style.WARNING(
+                    f"  [{usage}] {field_path}: '{lookup}' scans the table on {self.vendor}, "
+                    f"a plain index can't help"
+                )
+            )
+            return
+
+        self.stdout.write(self.style.WARNING(f"  [{usage}] {field_path}: NOT indexed"))
+        recommendations[(target_model._meta.label, field.name, index_kind)] = (
+            target_model
+        )
+
+    def print_explain(self, model, usage, field_path, lookup):
+        queryset = model._default_manager.using(self.database).all()
+        if usage == "ordering":
+            queryset = queryset.order_by(field_path)
+        elif lookup and lookup.split("__")[-1] == "in":
+            queryset = queryset.filter(**{field_path: ["x"]})
+        else:
+            queryset = queryset.filter(
+                **{field_path if lookup else f"{field_path}__exact": "x"}
+            )
+
+        try:
+            explain_output = queryset.explain()
+        except Exception as explain_e:
+            explain_output = f"EXPLAIN failed: {explain_e}"
+        for line in explain_output.splitlines():
+            self.stdout.write(f"      {line}")
+
+    def get_index(self, target_model, field, index_kind="btree"):
+        """
+        Builds the recommended index of a field.
+
+        :param target_model: the model of the field
+        :param field: the model field
+        :param str index_kind: "btree" (plain index), "upper" (UPPER() expression, for iexact), "pattern"
+            (LIKE pattern operator class, for startswith) or "upper_pattern" (both, for istartswith)
+        :return: django.db.models.Index
+        """
+        index = models.Index(fields=[field.name])
+        index.set_name_with_model(target_model)
+        if index_kind == "btree":
+            return index
+
+        name = f"{index.name[:-3]}{INDEX_SUFFIXES[index_kind]}"
+        if index_kind == "pattern":
+            return models.Index(
+                fields=[field.name], name=name, opclasses=[get_pattern_opclass(field)]
+            )
+        expression = Upper(field.name)
+        if index_kind == "upper_pattern":
+            from django.contrib.postgres.indexes import OpClass
+
+            expression = OpClass(expression, name=get_pattern_opclass(field))
+        return models.Index(expression, name=name)
+
+    def describe_index(self, target_model, field, index_kind):
+        """
+        Returns the recommended index as it is written in Meta.indexes.
+        """
+        name = self.get_index(target_model, field, index_kind).name
+        if index_kind == "pattern":
+            opclass = get_pattern_opclass(field)
+            return f'models.Index(fields=["{field.name}"], name="{name}", opclasses=["{opclass}"])'
+        if index_kind == "upper":
+            return f'models.Index(Upper("{field.name}"), name="{name}")'
+        if index_kind == "upper_pattern":
+            opclass = get_pattern_opclass(field)
+            return f'models.Index(OpClass(Upper("{field.name}"), name="{opclass}"), name="{name}")'
+        return f'models.Index(fields=["{field.name}"], name="{name}")'
+
+    def write_migrations(self, recommendations, app_labels):
+        """
+        Writes AddIndex migrations for the recommended indexes that the migration state doesn't have yet.
+
+        The models' Meta.indexes must be updated by hand, otherwise makemigrations removes the indexes again.
+        """
+        loader = MigrationLoader(connections[self.database], ignore_no_migrations=True)
+        project_state = loader.project_state()
+
+        operations_by_app = OrderedDict()
+        for (label, field_name, index_kind), target_model in recommendations.items():
+            app_label = target_model._meta.app_label
+            if app_labels and app_label not in app_labels:
+                continue
+
+            model_state = project_state.models.get(
+                (app_label, target_model._meta.model_name)
+            )
+            state_indexes = (
+                model_state.options.get("indexes", []) if model_state else []
+            )
+            index = self.get_index(
+                target_model, target_model._meta.get_field(field_name), index_kind
+            )
+            if any(is_same_index(state_index, index) for state_index in state_indexes):
+                self.stdout.write(
+                    f"  {label}.{field_name}: already added by a migration"
+                )
+                continue
+
+            operations_by_app.setdefault(app_label, []).append(
+                migrations.AddIndex(
+                    model_name=target_model._meta.model_name, index=index
+                )
+            )
+
+        if not operations_by_app:
+            self.stdout.write("No migrations to write.")
+            return
+
+        for app_label, operations in operations_by_app.items():
+            leaf_nodes = loader.graph.leaf_nodes(app_label)
+            if not leaf_nodes:
+                raise CommandError(
+                    f"App '{app_label}' has no migrations, run makemigrations first."
+                )
+
+            try:
+                migration_number = int(leaf_nodes[0][1].split("_")[0]) + 1
+            except ValueError:
+                migration_number = 1
+            migration_name = f"{migration_number:04d}_cbvhtmx_indexes"
+
+            migration = type(
+                "Migration",
+                (migrations.Migration,),
+                {"dependencies": leaf_nodes, "operations": operations},
+            )(migration_name, app_label)
+
+            writer = MigrationWriter(migration)
+            if os.path.exists(writer.path):
+                raise CommandError(f"{writer.path} already exists.")
+            with open(writer.path, "w", encoding="utf-8") as migration_file:
+                migration_file.write(writer.as_string())
+            self.stdout.write(self.style.SUCCESS(f"Wrote {writer.path}"))
+
+        self.stdout.write(
+            self.style.WARNING(
+                "Add the indexes above to the models' Meta.indexes, otherwise the next makemigrations removes them."
+            )
+        )
@@ -1,16 +1,69 @@
 # cbvhtmx\mixins.py
+import hashlib
 import logging
+import os
+import threading
+import time
+import uuid
 
+import django
+from asgiref.sync import sync_to_async
+from django.apps import apps
 from django.contrib.auth.mixins import UserPassesTestMixin
-from django.core.exceptions import FieldDoesNotExist
-from django.db.models import Q
-from django.http import Http404, HttpResponse
+from django.core.cache import caches
+from django.core.exceptions import (
+    FieldDoesNotExist,
+    ImproperlyConfigured,
+    ValidationError,
+)
+from django.core.handlers.asgi import ASGIRequest
+from django.core.paginator import InvalidPage, Page
+from django.db import connections, models, router, transaction
+from django.db.models import prefetch_related_objects
+from django.db.models.query import QuerySet
+from django.forms import FileField
+from django.forms.utils import ErrorDict
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    StreamingHttpResponse,
+)
 from django.http.request import QueryDict
+from django.template.loader import render_to_string
+from django.utils.html import format_html
+from django.utils.http import http_date, parse_http_date_safe
 
+from .admission import CacheSemaphore, FileLockSemaphore, estimate_row_count
+from .live import get_broker, get_model_channel, publish_changes, register_live_model
+from .query import QuerySpec
+from .replicas import using_read_database
+from .search_index import (
+    SearchIndexUnavailable,
+    get_search_index,
+    update_search_indexes,
+)
 from .services import (
     ExportFileProfile,
+    get_byte_range,
+    read_file_range,
     read_objects_into_xlsx,
     read_objects_into_csv,
+    remove_expired_export_files,
+    write_export_file,
+)
+from .tag_index import mark_tag_indexes_stale
+from .tools import (
+    CallbackTemplateResponse,
+    add_server_timing_header,
+    get_relation_versions,
+    get_row_cache_key,
+    register_row_cache_relation,
+    render_deleted_row,
+    render_row,
+    start_server_timing,
+    timed_phase,
 )
 
 logger = logging.getLogger(__name__)
@@ -23,6 +76,8 @@ class OrderingMixin:
     Uses attributes:
     - querydict - the output from a Django QueryDict object read from the request
     - ordering - the field name which to order by
+    - ordering_fields - the field names the "ordering" parameter may choose (None for every field of the model).
+    Sorting by an unindexed column scans the table, see the index_advisor command
 
     The mixin reads the request URL to check for an "ordering" parameter.
     If the URL contains an "ordering" parameter the ENTIRE QueryDict is copied to the querydict attribute
@@ -30,13 +85,20 @@ class OrderingMixin:
 
     querydict = None
     ordering = None
+    ordering_fields = None
 
     def dispatch(self, request, *args, **kwargs):
+        start_server_timing(request)
 
         if "ordering" in request.GET:
             ordering = request.GET["ordering"]
             try:
                 self.model._meta.get_field(ordering.strip("-"))
+                if (
+                    self.ordering_fields is not None
+                    and ordering.strip("-") not in self.ordering_fields
+                ):
+                    raise FieldDoesNotExist(ordering)
                 self.ordering = ordering
                 # registering a valid querydict
                 # sets querydict field for easy usage in template (view.querydict)
@@ -44,7 +106,11 @@ class OrderingMixin:
             except FieldDoesNotExist:
                 pass
 
-        return super().dispatch(request, *args, **kwargs)
+        response = super().dispatch(request, *args, **kwargs)
+        return add_server_timing_header(request, response)
+
+    def get_queryset(self):
+        return using_read_database(self.request, super().get_queryset())
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -68,21 +134,75 @@ class FieldQueryMixin:
     - querydict - the output from a Django QueryDict object read from the request
     - query - the decoded query
     - query_fields - a list of fields or query string (such as "fieldname__in")
+    - query_lookups - a dictionary of query_fields entries and the lookup used for them (e.g. {"serial": "istartswith"})
+    - query_index - if True, searches are answered by an in-process search index (see cbvhtmx.search_index). Every
+    worker process keeps its own index, changes from other workers show up after query_index_max_age seconds
+    - query_index_max_age - the seconds after which the search index is rebuilt (None to rely on signals only, for a
+    single process)
+    - query_index_memory_budget - the maximum size of the search index in bytes
+    - query_index_max_results - searches with more matches than this are answered by the database
 
     The mixin reads the request URL to check for an "q" parameter.
     If the URL contains an "q" parameter the ENTIRE QueryDict is copied to the querydict attribute
 
     Entries in the query_fields should be either of type string (the name of the model field or the query string).
-    A string with a dunder (__) is assumed to be query string
+    A string with a dunder (__) is assumed to be query string, without a lookup ("tags__name") it is compared exactly
     A string with a dunder and in (__in) is assumed to be a query string for use with a list object. When the query
     is constructed, the query value will be inserted into an empty list
+    Text fields are searched with "icontains", unless query_lookups sets a lookup an index can serve such as "iexact" or
+    "istartswith" (on PostgreSQL only an UPPER() or pattern_ops index can, see the index_advisor command). Other
+    fields (numbers, dates, ...) are only searched if the value can be converted for the field, and then exactly or by
+    range ("2022-01-01..2022-06-30").
+
+    The query fields are compiled and validated once per view class (see cbvhtmx.query.QuerySpec).
+    The "q" parameter can contain several words, "quoted phrases" and field:value tokens (e.g. "serial:X12").
     """
 
     querydict = None
     query = None
     query_fields = []
+    query_lookups = {}
+    query_index = False
+    query_index_memory_budget = 64 * 1024 * 1024
+    query_index_max_results = 5000
+    query_index_max_age = 300
+    _query_spec = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._query_spec = None
+        # views imported before the app registry is ready are compiled on their first request
+        if apps.ready and getattr(cls, "model", None) is not None and cls.query_fields:
+            cls.get_query_spec()
+
+    @classmethod
+    def get_query_spec(cls):
+        if cls._query_spec is None:
+            cls._query_spec = QuerySpec(cls.model, cls.query_fields, cls.query_lookups)
+        return cls._query_spec
+
+    def search_query_index(self, query_spec):
+        """
+        Returns the primary keys matching the query from the search index, or None to query the database.
+        """
+        if not self.query_index:
+            return None
+        try:
+            search_index = get_search_index(
+                query_spec,
+                memory_budget=self.query_index_memory_budget,
+                max_age=self.query_index_max_age,
+            )
+            matching_pks = search_index.search(self.query)
+        except SearchIndexUnavailable as index_e:
+            logger.debug(f"Search index not used: {index_e}")
+            return None
+        if len(matching_pks) > self.query_index_max_results:
+            return None
+        return matching_pks
 
     def dispatch(self, request, *args, **kwargs):
+        start_server_timing(request)
 
         if "q" in request.GET:
             query = request.GET["q"]
@@ -91,27 +211,24 @@ class FieldQueryMixin:
                 self.querydict = request.GET.urlencode()
                 self.query = query
 
-        return super().dispatch(request, *args, **kwargs)
+        response = super().dispatch(request, *args, **kwargs)
+        return add_server_timing_header(request, response)
 
     def get_queryset(self):
         if self.query:
 
-            queryset = super().get_queryset()
+            queryset = using_read_database(self.request, super().get_queryset())
 
-            q_filter = Q()
-            for field_entry in self.query_fields:
-                if isinstance(field_entry, str) and field_entry.__contains__("__in"):
-                    q_filter |= Q(**{field_entry: [self.query]})
-                elif isinstance(field_entry, str) and field_entry.__contains__("__"):
-                    q_filter |= Q(**{field_entry: self.query})
-                elif isinstance(field_entry, str):
-                    icontains_str = f"{field_entry}__icontains"
-                    q_filter |= Q(**{icontains_str: self.query})
+            with timed_phase(self.request, "filter"):
+                query_spec = self.get_query_spec()
+                matching_pks = self.search_query_index(query_spec)
+                if matching_pks is not None:
+                    return queryset.filter(pk__in=matching_pks)
 
-            filtered_queryset = queryset.filter(q_filter).distinct()
+                filtered_queryset = query_spec.filter_queryset(queryset, self.query)
             return filtered_queryset
         else:
-            return super().get_queryset()
+            return using_read_database(self.request, super().get_queryset())
 
 
 class TagsMixin:
@@ -128,8 +245,33 @@ class TagsMixin:
     tags_field = "tags"
     tag_name_field = "name"
 
+    def dispatch(self, request, *args, **kwargs):
+        start_server_timing(request)
+        response = super().dispatch(request, *args, **kwargs)
+        return add_server_timing_header(request, response)
+
     def get_queryset(self):
-        return super().get_queryset().prefetch_related(self.tags_field)
+        queryset = using_read_database(self.request, super().get_queryset())
+        return queryset.prefetch_related(self.tags_field)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        object_list = context.get("object_list")
+        if (
+            getattr(self.request, "server_timing", None) is not None
+            and isinstance(object_list, QuerySet)
+            and object_list._result_cache is None
+        ):
+            # the rows are only read if the template or the export uses them (in their phase), the prefetch that
+            # follows is timed apart
+            run_prefetches = object_list._prefetch_related_objects
+
+            def timed_prefetches():
+                with timed_phase(self.request, "tags"):
+                    run_prefetches()
+
+            object_list._prefetch_related_objects = timed_prefetches
+        return context
 
 
 class HxMixin:
@@ -142,15 +284,21 @@ class HxMixin:
 
     If a View specifies an "hx_template" attribute and the request is identified as an HTMX request, the specified
     template is loaded when the View is called
+
+    If the setting CBVHTMX_SERVER_TIMING is True, responses of views using the cbvhtmx mixins carry a "Server-Timing"
+    header with the duration and query count of each phase (filter, paginate, render or export, and tags for the
+    prefetch of the rows read while rendering or exporting).
     """
 
     hx = False
     hx_template = None
 
     def dispatch(self, request, *args, **kwargs):
+        start_server_timing(request)
         if "HX-Request" in request.headers and request.headers["HX-Request"]:
             self.hx = True
-        return super().dispatch(request, *args, **kwargs)
+        response = super().dispatch(request, *args, **kwargs)
+        return add_server_timing_header(request, response)
 
     def get_template_names(self):
         if self.hx and self.hx_template:
@@ -158,10 +306,1014 @@ class HxMixin:
         else:
             return super().get_template_names()
 
+    def paginate_queryset(self, queryset, page_size):
+        with timed_phase(self.request, "paginate"):
+            return super().paginate_queryset(queryset, page_size)
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super().render_to_response(context, **response_kwargs)
+        if getattr(self.request, "server_timing", None) is not None and hasattr(
+            response, "render"
+        ):
+            # renders now instead of after the view returns, so rendering is part of the timing
+            with timed_phase(self.request, "render"):
+                response.render()
+        return response
+
+
+class HxFragmentsMixin:
+    """
+    A mixin for HTMX views that renders several named fragments in one response.
+
+    Uses attributes:
+    - hx_fragments - a dictionary of fragment names and templates, e.g. {"list": "...", "counts": "..."}
+    - hx_fragments_param - the request parameter listing the fragments to render, e.g. "?fragments=list,counts"
+
+    The view dispatches once (query parsing, ordering, permission checks) and the queryset is evaluated once for all
+    fragments. The first requested fragment is the main content swapped into the request's target; all following
+    fragments get the context variable "hx_oob" and must add hx-swap-oob="true" to their root element:
+    <p id="result-count" {% if hx_oob %}hx-swap-oob="true"{% endif %}>...</p>
+    """
+
+    hx_fragments = {}
+    hx_fragments_param = "fragments"
+
+    def get_requested_fragments(self):
+        fragment_names = [
+            name.strip()
+            for name in self.request.GET.get(self.hx_fragments_param, "").split(",")
+            if name.strip()
+        ]
+        for name in fragment_names:
+            if name not in self.hx_fragments:
+                raise Http404(f"Fragment {name} not supported.")
+        return fragment_names
+
+    def render_to_response(self, context, **response_kwargs):
+        fragment_names = self.get_requested_fragments() if self.hx else []
+        if not fragment_names:
+            return super().render_to_response(context, **response_kwargs)
+
+        object_list = context.get("object_list")
+        if isinstance(object_list, QuerySet):
+            # fills the result cache, so all fragments share one query
+            len(object_list)
+
+        rendered_fragments = []
+        for index, name in enumerate(fragment_names):
+            fragment_context = dict(context, hx_oob=index > 0, hx_fragment=name)
+            rendered_fragments.append(
+                render_to_string(
+                    self.hx_fragments[name], fragment_context, request=self.request
+                )
+            )
+
+        return HttpResponse("".join(rendered_fragments), **response_kwargs)
+
+
+class InfiniteScrollMixin:
+    """
+    A mixin for paginated HTMX list views that load the next page when the end of the list is revealed.
+
+    Uses attributes:
+    - scroll_sentinel_colspan - the colspan of the sentinel row's cell
+    - scroll_prefetch - whether the next page is fetched after the current page was sent
+    - scroll_cache_alias/scroll_cache_timeout - where and how long prefetched pages are kept
+
+    The context variable "scroll_sentinel" holds a row with hx-trigger="revealed" which requests the next page and
+    replaces itself with it. It is empty on the last page.
+
+    After the response was sent, the next page is fetched and stored in the cache for the user's session, so the
+    next reveal is answered without querying the database. Prefetching only happens for requests with a session.
+    """
+
+    scroll_sentinel_colspan = 4
+    scroll_prefetch = True
+    scroll_cache_alias = "default"
+    scroll_cache_timeout = 30
+    response_class = CallbackTemplateResponse
+
+    def get_scroll_cache_key(self, page_number):
+        session_key = self.request.session.session_key
+        query_dict = self.request.GET.copy()
+        query_dict.pop(self.page_kwarg, None)
+        query_hash = hashlib.sha1(
+            f"{self.request.path}?{query_dict.urlencode()}".encode("utf-8")
+        ).hexdigest()
+        return f"cbvhtmx:scroll:{session_key}:{query_hash}:{page_number}"
+
+    def has_scroll_session(self):
+        session = getattr(self.request, "session", None)
+        return bool(session is not None and session.session_key)
+
+    def paginate_queryset(self, queryset, page_size):
+        page_number = self.kwargs.get(self.page_kwarg) or self.request.GET.get(
+            self.page_kwarg
+        )
+        if self.scroll_prefetch and page_number and self.has_scroll_session():
+            cache = caches[self.scroll_cache_alias]
+            cache_key = self.get_scroll_cache_key(page_number)
+            prefetched = cache.get(cache_key)
+            if prefetched is not None:
+                cache.delete(cache_key)
+                object_list, count = prefetched
+                paginator = self.get_paginator(
+                    queryset,
+                    page_size,
+                    orphans=self.get_paginate_orphans(),
+                    allow_empty_first_page=self.get_allow_empty(),
+                )
+                # the cached count keeps the paginator from querying
+                paginator.count = count
+                page = Page(object_list, int(page_number), paginator)
+                return paginator, page, page.object_list, page.has_other_pages()
+
+        return super().paginate_queryset(queryset, page_size)
+
+    def prefetch_next_page(self, page):
+        try:
+            next_page = page.paginator.page(page.next_page_number())
+        except InvalidPage:
+            return
+        caches[self.scroll_cache_alias].set(
+            self.get_scroll_cache_key(next_page.number),
+            (list(next_page.object_list), page.paginator.count),
+            self.scroll_cache_timeout,
+        )
+
+    def get_scroll_sentinel(self, page):
+        if not page or not page.has_next():
+            return ""
+        query_dict = self.request.GET.copy()
+        query_dict[self.page_kwarg] = page.next_page_number()
+        return format_html(
+            '<tr id="next-section" hx-get="{}?{}" hx-trigger="revealed" hx-swap="outerHTML">'
+            '<td colspan="{}"></td></tr>',
+            self.request.path,
+            query_dict.urlencode(),
+            self.scroll_sentinel_colspan,
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["scroll_sentinel"] = self.get_scroll_sentinel(context.get("page_obj"))
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super().render_to_response(context, **response_kwargs)
+        page = context.get("page_obj")
+        if (
+            self.scroll_prefetch
+            and page is not None
+            and page.has_next()
+            and self.has_scroll_session()
+            and hasattr(response, "close_callbacks")
+        ):
+            response.close_callbacks.append(lambda: self.prefetch_next_page(page))
+        return response
+
+
+class HxDiffMixin:
+    """
+    A mixin for HTMX list views that only sends the rows that changed since the version shown by the client.
+
+    Uses attributes:
+    - diff_row_template - a template rendering a single row (context: object, view, row_id, diff_oob)
+    - diff_version_field - a model field that changes whenever a row changes (e.g. an "updated" timestamp). If None,
+    rows are compared by their rendered HTML
+    - diff_version_param - the request parameter holding the client's version
+    - diff_row_id - format string for the row element id, receives the object's pk
+    - diff_container_id - the id of the element holding the rows (e.g. the tbody)
+    - diff_version_input_id - the id of the hidden input holding the version (updated out of band)
+    - diff_row_tag - the tag of the row element
+    - diff_wrapper_tag - the tag wrapping inserted rows (must be a valid parent of the row element)
+    - diff_cache_alias/diff_cache_timeout - where and how long the row snapshots of each version are kept
+
+    Every response carries its version in the "HX-List-Version" header and in the "diff_version" context variable,
+    which the template should render into an input the next request includes (hx-include).
+    If the client's version is known, the response only contains "hx-swap-oob" fragments:
+    - changed rows are rendered with diff_oob set to "true"
+    - added rows are inserted after their predecessor (wrapped in diff_wrapper_tag)
+    - removed rows are deleted
+    If the rows were reordered or the version is unknown, the whole template is rendered.
+    Row templates must render the row's id from row_id and add hx-swap-oob="{{ diff_oob }}" if diff_oob is set.
+    """
+
+    diff_row_template = None
+    diff_version_field = None
+    diff_version_param = "version"
+    diff_row_id = "entry-{}"
+    diff_container_id = "list-content"
+    diff_version_input_id = "list-version"
+    diff_row_tag = "tr"
+    diff_wrapper_tag = "tbody"
+    diff_cache_alias = "default"
+    diff_cache_timeout = 600
+
+    def get_diff_cache_key(self, version):
+        return f"cbvhtmx:diff:{version}"
+
+    def render_row(self, row_object, diff_oob=None):
+        return render_row(
+            self,
+            self.diff_row_template,
+            row_object,
+            self.diff_row_id.format(row_object.pk),
+            diff_oob,
+        )
+
+    def get_row_fingerprint(self, row_object):
+        if self.diff_version_field:
+            return str(getattr(row_object, self.diff_version_field))
+        row_html = self.render_row(row_object)
+        return hashlib.sha1(row_html.encode("utf-8")).hexdigest()
+
+    def get_rows_version(self, rows):
+        query_dict = self.request.GET.copy()
+        query_dict.pop(self.diff_version_param, None)
+        version_hash = hashlib.sha1(query_dict.urlencode().encode("utf-8"))
+        for pk, fingerprint in rows:
+            version_hash.update(f"|{pk}:{fingerprint}".encode("utf-8"))
+        return version_hash.hexdigest()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        if self.diff_row_template:
+            row_objects = list(context["object_list"])
+            rows = [
+                (row_object.pk, self.get_row_fingerprint(row_object))
+                for row_object in row_objects
+            ]
+            self.diff_version = self.get_rows_version(rows)
+            self.diff_rows = rows
+            self.diff_objects = {
+                row_object.pk: row_object for row_object in row_objects
+            }
+            caches[self.diff_cache_alias].set(
+                self.get_diff_cache_key(self.diff_version),
+                rows,
+                self.diff_cache_timeout,
+            )
+            context["diff_version"] = self.diff_version
+        return context
+
+    def get_diff_fragments(self, old_rows):
+        """
+        Builds the out-of-band fragments turning the old rows into the current rows.
+
+        :param list old_rows: list of tuples (pk, fingerprint) the client is showing
+        :return: list of HTML strings, or None if the rows can't be diffed (reordered)
+        """
+        old_fingerprints = dict(old_rows)
+        current_fingerprints = dict(self.diff_rows)
+
+        old_order = [pk for pk, _ in old_rows if pk in current_fingerprints]
+        current_order = [pk for pk, _ in self.diff_rows if pk in old_fingerprints]
+        if old_order != current_order:
+            return None
+
+        fragments = []
+        for pk, _ in old_rows:
+            if pk not in current_fingerprints:
+                fragments.append(
+                    render_deleted_row(self.diff_row_tag, self.diff_row_id.format(pk))
+                )
+
+        previous_pk = None
+        for pk, fingerprint in self.diff_rows:
+            row_object = self.diff_objects[pk]
+            if pk not in old_fingerprints:
+                if previous_pk is None:
+                    oob_target = f"afterbegin:#{self.diff_container_id}"
+                else:
+                    oob_target = f"afterend:#{self.diff_row_id.format(previous_pk)}"
+                fragments.append(
+                    f'<{self.diff_wrapper_tag} hx-swap-oob="{oob_target}">'
+                    f"{self.render_row(row_object)}"
+                    f"</{self.diff_wrapper_tag}>"
+                )
+            elif old_fingerprints[pk] != fingerprint:
+                fragments.append(self.render_row(row_object, diff_oob="true"))
+            previous_pk = pk
+
+        return fragments
+
+    def render_to_response(self, context, **response_kwargs):
+        client_version = self.request.GET.get(self.diff_version_param)
+        if self.hx and self.diff_row_template and client_version:
+            if client_version == self.diff_version:
+                response = HttpResponse(status=204)
+                response["HX-List-Version"] = self.diff_version
+                return response
+
+            old_rows = caches[self.diff_cache_alias].get(
+                self.get_diff_cache_key(client_version)
+            )
+            fragments = (
+                self.get_diff_fragments(old_rows) if old_rows is not None else None
+            )
+            if fragments is not None:
+                fragments.append(
+                    format_html(
+                        '<input type="hidden" id="{}" name="{}" value="{}" hx-swap-oob="true">',
+                        self.diff_version_input_id,
+                        self.diff_version_param,
+                        self.diff_version,
+                    )
+                )
+                # the main target stays untouched, everything is swapped out of band
+                response = HttpResponse("".join(fragments))
+                response["HX-Reswap"] = "none"
+                response["HX-List-Version"] = self.diff_version
+                return response
+
+        response = super().render_to_response(context, **response_kwargs)
+        if self.diff_row_template:
+            response["HX-List-Version"] = self.diff_version
+        return response
+
+
+class LiveListMixin:
+    """
+    A mixin for list views that pushes changed rows to the client over Server-Sent Events instead of polling.
+
+    Uses attributes:
+    - live_param - the request parameter that opens the event stream (e.g. "?live=1")
+    - live_row_template - a template rendering a single row (context: object, view, row_id, diff_oob)
+    - live_row_id - format string for the row element id, receives the object's pk
+    - live_container_id - the id of the element new rows are inserted into
+    - live_row_tag - the tag of the row element
+    - live_wrapper_tag - the tag wrapping inserted rows (must be a valid parent of the row element)
+    - live_event - the name of the SSE event carrying the row fragments
+    - live_keepalive - seconds between keepalive comments on an idle stream
+
+    Saving or deleting an object of the view's model publishes a message through the broker (see cbvhtmx.live).
+    Every open stream checks the object against its own queryset (including the query and filters of the request
+    that opened it) and sends the row as an hx-swap-oob fragment: updated rows replace themselves, created rows are
+    inserted at the top of the container and deleted rows, or rows no longer matching the filter, are removed.
+
+    The stream needs an ASGI server and Django >= 4.2 (async iterators in StreamingHttpResponse), other requests for
+    it get a 400 response, because a WSGI worker would try to read the endless stream to its end. Use it with the
+    HTMX sse extension, for example:
+    <tbody id="list-content" hx-ext="sse" sse-connect="?{{ view.querydict|default:'' }}&live=1" sse-swap="row"
+    hx-swap="none">
+    """
+
+    live_param = "live"
+    live_row_template = None
+    live_row_id = "entry-{}"
+    live_container_id = "list-content"
+    live_row_tag = "tr"
+    live_wrapper_tag = "tbody"
+    live_event = "row"
+    live_keepalive = 15
+
+    def dispatch(self, request, *args, **kwargs):
+        register_live_model(self.model)
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        if self.live_param in request.GET:
+            if not isinstance(request, ASGIRequest) or django.VERSION < (4, 2):
+                return HttpResponseBadRequest(
+                    "Live updates need an ASGI server and Django 4.2 or newer."
+                )
+            response = StreamingHttpResponse(
+                self.stream_changes(), content_type="text/event-stream"
+            )
+            response["Cache-Control"] = "no-cache"
+            # keeps nginx from buffering the stream
+            response["X-Accel-Buffering"] = "no"
+            return response
+        return super().get(request, *args, **kwargs)
+
+    def render_live_row(self, row_object, diff_oob):
+        return render_row(
+            self,
+            self.live_row_template,
+            row_object,
+            self.live_row_id.format(row_object.pk),
+            diff_oob,
+        )
+
+    def render_change(self, message):
+        """
+        Renders the fragments for a change message, or returns an empty string if the client isn't affected.
+
+        Messages for many objects ("pks") are read with one query.
+        """
+        pks = message["pks"] if "pks" in message else [message["pk"]]
+        row_objects = {}
+        if message["action"] == "save":
+            # the change was just committed on the primary, a replica may not have it yet
+            database = router.db_for_write(self.model)
+            row_objects = {
+                row_object.pk: row_object
+                for row_object in self.get_queryset().using(database).filter(pk__in=pks)
+            }
+
+        fragments = []
+        for pk in pks:
+            row_object = row_objects.get(pk)
+            if row_object is None:
+                if not message.get("created"):
+                    fragments.append(
+                        render_deleted_row(
+                            self.live_row_tag, self.live_row_id.format(pk)
+                        )
+                    )
+            elif message.get("created"):
+                fragments.append(
+                    f'<{self.live_wrapper_tag} hx-swap-oob="afterbegin:#{self.live_container_id}">'
+                    f"{self.render_live_row(row_object, diff_oob=None)}"
+                    f"</{self.live_wrapper_tag}>"
+                )
+            else:
+                fragments.append(self.render_live_row(row_object, diff_oob="true"))
+        return "".join(fragments)
+
+    async def stream_changes(self):
+        subscription = get_broker().subscribe(get_model_channel(self.model))
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                message = await subscription.get(timeout=self.live_keepalive)
+                if message is None:
+                    yield ": keepalive\n\n"
+                    continue
+                fragment = await sync_to_async(self.render_change)(message)
+                if fragment:
+                    data_lines = "".join(
+                        f"data: {line}\n" for line in fragment.splitlines()
+                    )
+                    yield f"event: {self.live_event}\n{data_lines}\n"
+        finally:
+            subscription.close()
+
+
+class RowCacheMixin:
+    """
+    A mixin for list views whose row templates use the cache_row template tag (see templatetags/row_cache.py).
+
+    Uses attributes:
+    - row_cache_fragment - the fragment name used by the cache_row tag in the row template
+    - row_cache_version_field - a model field that changes whenever a row changes (e.g. an "updated" timestamp). It
+    is required, unless get_row_cache_vary_on() is overridden
+    - row_cache_relations - many-to-many fields rendered in the row, their changes don't touch the version field.
+    Defaults to TagsMixin's tags_field
+    - row_cache_alias/row_cache_timeout - where and how long the rendered rows are kept
+
+    All rows of the page are read from the cache with one get_many() call and passed to the template in the context
+    variable "row_cache_fragments". Prefetches of the queryset (e.g. the tags from TagsMixin) are only run for the
+    rows missing from the cache, so only changed rows are queried and rendered. The mixin has to come before
+    TagsMixin in the view's bases for this.
+    Adding or removing related objects (m2m_changed) gives the row a new relation version in the cache, saving or
+    deleting a related object (e.g. renaming a tag) renews the rows of the whole model.
+    """
+
+    row_cache_fragment = "row"
+    row_cache_version_field = None
+    row_cache_relations = None
+    row_cache_relation_versions = {}
+    row_cache_alias = "default"
+    row_cache_timeout = 300
+    row_cache_prefetches = ()
+
+    def get_row_cache_relations(self):
+        if self.row_cache_relations is not None:
+            return self.row_cache_relations
+        tags_field = getattr(self, "tags_field", None)
+        return [tags_field] if tags_field else []
+
+    def dispatch(self, request, *args, **kwargs):
+        for field_name in self.get_row_cache_relations():
+            register_row_cache_relation(self.model, field_name, self.row_cache_alias)
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        self.row_cache_prefetches = queryset._prefetch_related_lookups
+        # the prefetches are run in get_context_data, for the rows that aren't cached only
+        return queryset.prefetch_related(None)
+
+    def get_row_cache_vary_on(self, row_object):
+        """
+        The values a row's fragment depends on, override it to vary on more than row_cache_version_field.
+        """
+        if not self.row_cache_version_field:
+            # without a version, edited rows would be served from the cache until they expire
+            raise ImproperlyConfigured(
+                f"{self.__class__.__name__} needs a row_cache_version_field or a get_row_cache_vary_on() override."
+            )
+        return [getattr(row_object, self.row_cache_version_field)]
+
+    def get_row_cache_key(self, row_object, fragment_name=None):
+        # the cache_row tag builds its keys with this method too, so the preloaded fragments are found
+        vary_on = list(self.get_row_cache_vary_on(row_object))
+        if self.get_row_cache_relations():
+            vary_on.append(self.row_cache_relation_versions.get(row_object.pk, ""))
+        return get_row_cache_key(
+            row_object, fragment_name or self.row_cache_fragment, vary_on
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        row_objects = list(context["object_list"])
+        if self.get_row_cache_relations():
+            self.row_cache_relation_versions = get_relation_versions(
+                self.model,
+                [row_object.pk for row_object in row_objects],
+                self.row_cache_alias,
+            )
+        row_keys = {
+            self.get_row_cache_key(row_object): row_object for row_object in row_objects
+        }
+        row_cache_fragments = caches[self.row_cache_alias].get_many(list(row_keys))
+
+        missing_rows = [
+            row_object
+            for key, row_object in row_keys.items()
+            if key not in row_cache_fragments
+        ]
+        if missing_rows and self.row_cache_prefetches:
+            prefetch_related_objects(missing_rows, *self.row_cache_prefetches)
+
+        context["row_cache_fragments"] = row_cache_fragments
+        return context
+
+
+class InlineValidationMixin:
+    """
+    A mixin for CreateViews and UpdateViews that validates a single form field for inline HTMX feedback.
+
+    Uses attributes:
+    - inline_validation_param - the request parameter naming the field to validate
+    - inline_validation_dependencies - a dictionary of field names and the fields their validation needs, e.g.
+    {"end_date": ["start_date"]}
+    - inline_validation_template - a template rendering the field (context: field, form, view). If None, the widget
+    and errors are rendered in a div with the id from inline_field_id
+    - inline_field_id - format string for the id of the field's container, receives the field name
+    - inline_unique_cache_timeout - seconds a uniqueness lookup is reused for the same value
+
+    A POST with the inline_validation_param (e.g. hx-post="...?validate=serial" hx-trigger="keyup changed delay:500ms"
+    hx-target="#div_id_serial" hx-swap="outerHTML") only cleans the field and its dependencies: the form field, the
+    form's clean_<field> method, the model field's validators and the uniqueness of the field. Uniqueness lookups are
+    cached, so repeated requests for the same value don't query the database again.
+    The form's clean() method isn't run, it is left to the full submit.
+    """
+
+    inline_validation_param = "validate"
+    inline_validation_dependencies = {}
+    inline_validation_template = None
+    inline_field_id = "div_id_{}"
+    inline_unique_cache_timeout = 10
+    inline_cache_alias = "default"
+
+    def get_inline_field_name(self):
+        return self.request.GET.get(
+            self.inline_validation_param
+        ) or self.request.POST.get(self.inline_validation_param)
+
+    def post(self, request, *args, **kwargs):
+        field_name = self.get_inline_field_name()
+        if not field_name:
+            return super().post(request, *args, **kwargs)
+
+        self.object = None
+        if self.pk_url_kwarg in self.kwargs or self.slug_url_kwarg in self.kwargs:
+            self.object = self.get_object()
+
+        form = self.get_form()
+        if field_name not in form.fields:
+            raise Http404(f"Field {field_name} not in form.")
+
+        field_names = [field_name] + [
+            name
+            for name in self.inline_validation_dependencies.get(field_name, [])
+            if name in form.fields
+        ]
+        self.clean_inline_fields(form, field_names)
+        return self.render_inline_field(form, field_name)
+
+    def clean_inline_fields(self, form, field_names):
+        """
+        Cleans a subset of the form's fields the way Form.full_clean() would, without the form-wide clean().
+        """
+        form._errors = ErrorDict()
+        form.cleaned_data = {}
+
+        for name in field_names:
+            bound_field = form[name]
+            field = bound_field.field
+            value = bound_field.initial if field.disabled else bound_field.data
+            try:
+                if isinstance(field, FileField):
+                    value = field.clean(value, bound_field.initial)
+                else:
+                    value = field.clean(value)
+                form.cleaned_data[name] = value
+                if hasattr(form, f"clean_{name}"):
+                    form.cleaned_data[name] = getattr(form, f"clean_{name}")()
+            except ValidationError as clean_e:
+                form.add_error(name, clean_e)
+
+        model = getattr(getattr(form, "_meta", None), "model", None)
+        if model is not None:
+            self.clean_inline_model_fields(form, model, field_names)
+
+    def clean_inline_model_fields(self, form, model, field_names):
+        instance = form.instance
+        checked_names = []
+        for name in field_names:
+            if name not in form.cleaned_data:
+                continue
+            try:
+                model_field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if not model_field.concrete or model_field.many_to_many:
+                continue
+            # like Model.clean_fields(): the form value is set first (a model instance for a ForeignKey) and the raw
+            # attribute (the key) is cleaned
+            model_field.save_form_data(instance, form.cleaned_data[name])
+            raw_value = getattr(instance, model_field.attname)
+            if not (model_field.blank and raw_value in model_field.empty_values):
+                try:
+                    value = model_field.clean(raw_value, instance)
+                except ValidationError as model_e:
+                    form.add_error(name, model_e)
+                    continue
+                setattr(instance, model_field.attname, value)
+            checked_names.append(name)
+
+        for unique_fields in self.get_unique_sets(model, field_names[0], checked_names):
+            if self.is_unique_taken(model, instance, unique_fields):
+                form.add_error(
+                    field_names[0], instance.unique_error_message(model, unique_fields)
+                )
+                break
+
+    def get_unique_sets(self, model, field_name, checked_names):
+        """
+        Returns the unique field sets containing the field whose other fields were cleaned as well.
+        """
+        if field_name not in checked_names:
+            return []
+        unique_sets = []
+        if model._meta.get_field(field_name).unique:
+            unique_sets.append((field_name,))
+        candidates = list(model._meta.unique_together) + [
+            constraint.fields
+            for constraint in model._meta.constraints
+            if isinstance(constraint, models.UniqueConstraint)
+            and constraint.fields
+            and constraint.condition is None
+        ]
+        for fields in candidates:
+            if field_name in fields and set(fields) <= set(checked_names):
+                unique_sets.append(tuple(fields))
+        return unique_sets
+
+    def is_unique_taken(self, model, instance, unique_fields):
+        lookup = {
+            name: getattr(instance, model._meta.get_field(name).attname)
+            for name in unique_fields
+        }
+        cache_key = (
+            "cbvhtmx:unique:"
+            + hashlib.sha1(
+                f"{model._meta.label_lower}|{instance.pk}|{sorted(lookup.items())!r}".encode(
+                    "utf-8"
+                )
+            ).hexdigest()
+        )
+        cache = caches[self.inline_cache_alias]
+        taken = cache.get(cache_key)
+        if taken is None:
+            queryset = model._default_manager.filter(**lookup)
+            if instance.pk is not None:
+                queryset = queryset.exclude(pk=instance.pk)
+            taken = queryset.exists()
+            cache.set(cache_key, taken, self.inline_unique_cache_timeout)
+        return taken
+
+    def render_inline_field(self, form, field_name):
+        bound_field = form[field_name]
+        if self.inline_validation_template:
+            content = render_to_string(
+                self.inline_validation_template,
+                {"field": bound_field, "form": form, "view": self},
+                request=self.request,
+            )
+        else:
+            content = format_html(
+                '<div id="{}">{}{}</div>',
+                self.inline_field_id.format(field_name),
+                bound_field.as_widget(),
+                bound_field.errors,
+            )
+        return HttpResponse(content)
+
+
+class BulkActionMixin:
+    """
+    A mixin for list views that updates every object matching the current search at once.
+
+    Uses attributes:
+    - bulk_update_fields - the model fields that can be set (POST parameters with the field name)
+    - bulk_tags_field - the name of the tags field for the "add_tags"/"remove_tags" POST parameters (comma-separated
+    tag names). Defaults to TagsMixin's tags_field
+    - bulk_chunk_size - the number of objects updated per transaction
+    - bulk_background_threshold - larger sets are updated in a background thread while a progress fragment polls
+    - bulk_progress_template - a template rendering the progress (context: job, view). If None a div with the id
+    "bulk-progress" is rendered
+    - bulk_job_param - the GET parameter the progress fragment polls with
+
+    The POST must be sent to the list URL with the current query string (e.g. hx-post="?{{ view.querydict }}"), so
+    FieldQueryMixin and OrderingMixin rebuild the same queryset the user is looking at.
+    Fields are updated with QuerySet.update() and tags with batched inserts into the through table, so save() and
+    the save/m2m signals are NOT called. The cbvhtmx search and tag indexes and the live broker are updated after
+    every chunk instead (see bulk_changed). Protect the view, e.g. with SuperuserRequiredMixin.
+    """
+
+    bulk_update_fields = []
+    bulk_tags_field = None
+    bulk_chunk_size = 1000
+    bulk_background_threshold = 5000
+    bulk_progress_template = None
+    bulk_job_param = "bulk_job"
+    bulk_cache_alias = "default"
+    bulk_cache_timeout = 3600
+
+    def get_bulk_tags_field(self):
+        return self.bulk_tags_field or getattr(self, "tags_field", None)
+
+    def get_bulk_job_key(self, job_id):
+        return f"cbvhtmx:bulk:{job_id}"
+
+    def get(self, request, *args, **kwargs):
+        job_id = request.GET.get(self.bulk_job_param)
+        if job_id:
+            job = caches[self.bulk_cache_alias].get(self.get_bulk_job_key(job_id))
+            if job is None:
+                raise Http404("Unknown bulk job.")
+            return self.render_bulk_progress(job)
+        return super().get(request, *args, **kwargs)
+
+    def get_bulk_updates(self):
+        """
+        Reads the field values to set from the POST data.
+
+        :return: dictionary of attribute names and values
+        :raises ValidationError: if a value is invalid for its field
+        """
+        updates = {}
+        for field_name in self.bulk_update_fields:
+            if field_name not in self.request.POST:
+                continue
+            model_field = self.model._meta.get_field(field_name)
+            value = self.request.POST[field_name]
+            if value == "" and model_field.null:
+                value = None
+            try:
+                updates[model_field.attname] = model_field.clean(value, None)
+            except ValidationError as field_e:
+                raise ValidationError({field_name: field_e.messages})
+        return updates
+
+    def get_bulk_tag_names(self, parameter):
+        return [
+            name.strip()
+            for name in self.request.POST.get(parameter, "").split(",")
+            if name.strip()
+        ]
+
+    def post(self, request, *args, **kwargs):
+        try:
+            updates = self.get_bulk_updates()
+        except ValidationError as bulk_e:
+            return HttpResponseBadRequest(
+                format_html(
+                    '<div id="bulk-progress">{}</div>', "; ".join(bulk_e.messages)
+                )
+            )
+        add_tags = self.get_bulk_tag_names("add_tags")
+        remove_tags = self.get_bulk_tag_names("remove_tags")
+        if not (updates or add_tags or remove_tags):
+            return HttpResponseBadRequest("Nothing to update.")
+
+        pks = list(self.get_queryset().order_by().values_list("pk", flat=True))
+        job = {
+            "id": uuid.uuid4().hex,
+            "total": len(pks),
+            "done": 0,
+            "finished": False,
+            "error": None,
+        }
+        caches[self.bulk_cache_alias].set(
+            self.get_bulk_job_key(job["id"]), job, self.bulk_cache_timeout
+        )
+
+        if len(pks) > self.bulk_background_threshold:
+            threading.Thread(
+                target=self.run_bulk_job,
+                args=(job, pks, updates, add_tags, remove_tags, True),
+                daemon=True,
+            ).start()
+        else:
+            self.run_bulk_job(job, pks, updates, add_tags, remove_tags)
+        return self.render_bulk_progress(job)
+
+    def run_bulk_job(self, job, pks, updates, add_tags, remove_tags, background=False):
+        cache = caches[self.bulk_cache_alias]
+        try:
+            tags_to_add = self.get_bulk_tags(add_tags, create=True)
+            tags_to_remove = self.get_bulk_tags(remove_tags, create=False)
+            for start in range(0, len(pks), self.bulk_chunk_size):
+                chunk = pks[start : start + self.bulk_chunk_size]
+                with transaction.atomic():
+                    if updates:
+                        self.model._default_manager.filter(pk__in=chunk).update(
+                            **updates
+                        )
+                    if tags_to_add:
+                        self.add_bulk_tags(chunk, tags_to_add)
+                    if tags_to_remove:
+                        self.remove_bulk_tags(chunk, tags_to_remove)
+                    self.bulk_changed(
+                        chunk, tags_changed=bool(tags_to_add or tags_to_remove)
+                    )
+                job["done"] += len(chunk)
+                cache.set(
+                    self.get_bulk_job_key(job["id"]), job, self.bulk_cache_timeout
+                )
+        except Exception as job_e:
+            logger.exception(f"Bulk job {job['id']} failed: {job_e}")
+            job["error"] = str(job_e)
+        finally:
+            job["finished"] = True
+            cache.set(self.get_bulk_job_key(job["id"]), job, self.bulk_cache_timeout)
+            if background:
+                connections.close_all()
+
+    def bulk_changed(self, pks, tags_changed=False):
+        """
+        Updates what the skipped signals would have: the search indexes, the tag indexes and the live broker (one
+        message for the chunk).
+
+        Runs inside the chunk's transaction, the updates are deferred until it is committed.
+        """
+        chunk = list(pks)
+
+        def update_indexes():
+            update_search_indexes(self.model, chunk)
+            if tags_changed:
+                mark_tag_indexes_stale(self.model)
+
+        transaction.on_commit(update_indexes)
+        publish_changes(self.model, chunk)
+
+    def get_tags_relation(self):
+        """
+        Returns the through model of the tags field and the lookups for the object and the tag.
+
+        :return: tuple (through model, dict of extra field values, object field name, tag field name)
+        """
+        tags_field = self.model._meta.get_field(self.get_bulk_tags_field())
+        through = tags_field.remote_field.through
+        tag_model = tags_field.related_model
+        object_field_name = None
+        tag_field_name = None
+        for through_field in through._meta.get_fields():
+            if not through_field.is_relation or not through_field.many_to_one:
+                continue
+            if through_field.related_model == tag_model and tag_field_name is None:
+                tag_field_name = through_field.name
+            elif (
+                through_field.related_model == self.model and object_field_name is None
+            ):
+                object_field_name = through_field.attname
+
+        extra_values = {}
+        if object_field_name is None:
+            from django.contrib.contenttypes.models import ContentType
+
+            # generic relation like taggit's TaggedItem
+            object_field_name = "object_id"
+            extra_values["content_type"] = ContentType.objects.get_for_model(self.model)
+        return through, extra_values, object_field_name, tag_field_name
+
+    def get_bulk_tags(self, names, create):
+        if not names:
+            return []
+        tags_field = self.model._meta.get_field(self.get_bulk_tags_field())
+        tag_model = tags_field.related_model
+        tag_name_field = getattr(self, "tag_name_field", "name")
+        if create:
+            return [
+                tag_model._default_manager.get_or_create(**{tag_name_field: name})[0]
+                for name in names
+            ]
+        return list(
+            tag_model._default_manager.filter(**{f"{tag_name_field}__in": names})
+        )
+
+    def add_bulk_tags(self, pks, tags):
+        through, extra_values, object_field_name, tag_field_name = (
+            self.get_tags_relation()
+        )
+        existing = set(
+            through._default_manager.filter(
+                **extra_values,
+                **{f"{object_field_name}__in": pks, f"{tag_field_name}__in": tags},
+            ).values_list(object_field_name, f"{tag_field_name}_id")
+        )
+        through._default_manager.bulk_create(
+            [
+                through(**extra_values, **{object_field_name: pk, tag_field_name: tag})
+                for pk in pks
+                for tag in tags
+                if (pk, tag.pk) not in existing
+            ],
+            batch_size=self.bulk_chunk_size,
+        )
+
+    def remove_bulk_tags(self, pks, tags):
+        through, extra_values, object_field_name, tag_field_name = (
+            self.get_tags_relation()
+        )
+        through._default_manager.filter(
+            **extra_values,
+            **{f"{object_field_name}__in": pks, f"{tag_field_name}__in": tags},
+        ).delete()
+
+    def render_bulk_progress(self, job):
+        if self.bulk_progress_template:
+            content = render_to_string(
+                self.bulk_progress_template,
+                {"job": job, "view": self},
+                request=self.request,
+            )
+        elif job["error"]:
+            content = format_html(
+                '<div id="bulk-progress">Failed after {} of {} objects: {}</div>',
+                job["done"],
+                job["total"],
+                job["error"],
+            )
+        elif job["finished"]:
+            content = format_html(
+                '<div id="bulk-progress">Updated {} objects.</div>', job["total"]
+            )
+        else:
+            content = format_html(
+                '<div id="bulk-progress" hx-get="{}?{}={}" hx-trigger="every 1s" hx-swap="outerHTML">'
+                "Updating {} of {} objects...</div>",
+                self.request.path,
+                self.bulk_job_param,
+                job["id"],
+                job["done"],
+                job["total"],
+            )
+        return HttpResponse(content)
+
 
 class ExportMixin:
     """
     A mixin that returns files for ListViews
+
+    Uses attributes for cached export files (optional):
+    - export_directory - a local directory in which finished export files are kept. If None, files are built in
+    memory for every request
+    - export_max_age - the number of seconds a file in the export_directory is reused before it is rebuilt. Older
+    files are deleted whenever a new file is written
+    - export_cache_per_user - whether every user gets their own export files (see get_export_cache_key)
+    - export_sendfile_header - "X-Accel-Redirect" (nginx) or "X-Sendfile" (Apache) to hand the transfer off to the
+    web server
+    - export_sendfile_prefix - the internal URL prefix mapped to the export_directory (only for X-Accel-Redirect)
+
+    Uses attributes for admission control (optional):
+    - export_max_concurrent - the number of exports running at once on the host (None for no limit)
+    - export_lock_directory - a directory for the lock files of the host-wide limit, it must not be the
+    export_directory (expired files are deleted there). If None, the limit is counted in the cache, which must be
+    shared between the workers (e.g. Redis or Memcached)
+    - export_user_limit - the number of exports a user can run at once (None for no limit)
+    - export_max_rows - exports with more (estimated) rows are refused (None for no limit)
+    - export_retry_after - the seconds a refused client should wait before retrying
+    - export_admission_timeout - the seconds an HTMX client has to start the download it was admitted to
+
+    Refused requests get a 429 response with a "Retry-After" header. HTMX requests get a "queued" fragment instead,
+    which retries by itself and redirects to the download (HX-Redirect) once a slot is free. The redirect URL carries
+    an admission token (parameter export_admission_param) bound to the search and the user. The download still takes
+    a slot; if none is free again, it gets a page that reloads itself after export_retry_after seconds instead of a
+    bare 429. Exports above export_max_rows get a 403 response (a fragment for HTMX requests).
+
+    Like the list mixins, exports read from the replica database if CBVHTMX_REPLICA_DATABASE is set (see
+    cbvhtmx.replicas).
+
+    Export files are stored under a name built from the view, the extension and the request's query parameters, so
+    the same search returns the same file. Files served by Django support "Range" requests (206 Partial Content),
+    so interrupted downloads can be resumed.
     """
 
     extension = None
@@ -169,6 +1321,19 @@ class ExportMixin:
     export_fields = []
     export_types = {}
     use_defaults = True
+    export_directory = None
+    export_max_age = 300
+    export_cache_per_user = True
+    export_sendfile_header = None
+    export_sendfile_prefix = None
+    export_max_concurrent = None
+    export_lock_directory = None
+    export_user_limit = None
+    export_max_rows = None
+    export_retry_after = 10
+    export_admission_param = "admitted"
+    export_admission_timeout = 30
+    export_cache_alias = "default"
     _default_types = {
         "xlsx": ExportFileProfile(
             extension="xlsx",
@@ -194,6 +1359,7 @@ class ExportMixin:
         return export_file_profile.content_type
 
     def dispatch(self, request, *args, **kwargs):
+        start_server_timing(request)
         # add default types if user didn't specify one
         if self.use_defaults:
             for type_key, type_entry in self._default_types.items():
@@ -205,22 +1371,278 @@ class ExportMixin:
             if extension not in self.export_types:
                 raise Http404(f"Extension {extension} not supported.")
             self.extension = extension
-        return super().dispatch(request, *args, **kwargs)
+        response = super().dispatch(request, *args, **kwargs)
+        return add_server_timing_header(request, response)
+
+    def get_queryset(self):
+        return using_read_database(self.request, super().get_queryset())
+
+    def get_export_semaphores(self):
+        semaphores = []
+        if self.export_max_concurrent:
+            if self.export_lock_directory:
+                semaphores.append(
+                    FileLockSemaphore(
+                        os.fspath(self.export_lock_directory),
+                        self.export_max_concurrent,
+                    )
+                )
+            else:
+                semaphores.append(
+                    CacheSemaphore("cbvhtmx:export:host", self.export_max_concurrent)
+                )
+        if self.export_user_limit and self.request.user.is_authenticated:
+            semaphores.append(
+                CacheSemaphore(
+                    f"cbvhtmx:export:user:{self.request.user.pk}",
+                    self.export_user_limit,
+                )
+            )
+        return semaphores
+
+    def get_export_refusal(self, status, message, retry_after=None, admitted=False):
+        if self.request.headers.get("HX-Request") and retry_after:
+            response = HttpResponse(
+                format_html(
+                    '<div id="export-queued" hx-get="{}" hx-trigger="load delay:{}s" hx-swap="outerHTML">{}</div>',
+                    self.request.get_full_path(),
+                    retry_after,
+                    message,
+                )
+            )
+        elif self.request.headers.get("HX-Request"):
+            # htmx doesn't swap error responses, the message wouldn't be shown
+            response = HttpResponse(
+                format_html('<div id="export-refused">{}</div>', message)
+            )
+            response["HX-Reswap"] = "outerHTML"
+        elif admitted and retry_after:
+            # the browser was sent here by HX-Redirect, a page that retries by itself
+            response = HttpResponse(
+                format_html(
+                    '<html><head><meta http-equiv="refresh" content="{}"></head><body>{}</body></html>',
+                    retry_after,
+                    message,
+                ),
+                status=status,
+            )
+        else:
+            response = HttpResponse(message, status=status)
+        if retry_after:
+            response["Retry-After"] = str(retry_after)
+        return response
+
+    def get_export_query_string(self):
+        """
+        Returns the request's query parameters without the admission token, sorted.
+        """
+        query_params = self.request.GET.copy()
+        query_params.pop(self.export_admission_param, None)
+        return "&".join(sorted(query_params.urlencode().split("&")))
+
+    def get_export_admission(self):
+        """
+        Returns what an admission token is bound to: the path, the search and the user.
+        """
+        user = getattr(self.request, "user", None)
+        user_pk = user.pk if user is not None and user.is_authenticated else None
+        return [self.request.path, self.get_export_query_string(), user_pk]
+
+    def admit_export(self):
+        """
+        Issues an admission token and returns the download URL carrying it.
+        """
+        token = uuid.uuid4().hex
+        caches[self.export_cache_alias].set(
+            f"cbvhtmx:export:admitted:{token}",
+            self.get_export_admission(),
+            self.export_admission_timeout,
+        )
+        query_string = self.get_export_query_string()
+        admission = f"{self.export_admission_param}={token}"
+        return (
+            f"{self.request.path}?{query_string}&{admission}"
+            if query_string
+            else f"{self.request.path}?{admission}"
+        )
+
+    def get_export_admission_key(self):
+        token = self.request.GET.get(self.export_admission_param)
+        return f"cbvhtmx:export:admitted:{token}" if token else None
+
+    def is_export_admitted(self):
+        """
+        Returns whether the request carries a valid admission token for its own search and user.
+        """
+        admission_key = self.get_export_admission_key()
+        if admission_key is None:
+            return False
+        admission = caches[self.export_cache_alias].get(admission_key)
+        return admission == self.get_export_admission()
+
+    def get(self, request, *args, **kwargs):
+        if self.export_directory and self.is_export_file_fresh(
+            self.get_export_file_path()
+        ):
+            # serving a finished file is cheap
+            return super().get(request, *args, **kwargs)
+
+        # the row limit was checked for the same search and user before the token was issued
+        admitted = self.is_export_admitted()
+        if self.export_max_rows is not None and not admitted:
+            estimated_rows = estimate_row_count(self.get_queryset())
+            if estimated_rows > self.export_max_rows:
+                return self.get_export_refusal(
+                    403,
+                    f"The export would contain about {estimated_rows} rows, the limit is {self.export_max_rows}. "
+                    f"Please narrow the search.",
+                )
+
+        acquired = []
+        try:
+            for semaphore in self.get_export_semaphores():
+                token = semaphore.acquire()
+                if token is None:
+                    return self.get_export_refusal(
+                        429,
+                        "Export queued, it starts as soon as possible.",
+                        self.export_retry_after,
+                        admitted=admitted,
+                    )
+                acquired.append((semaphore, token))
+
+            if request.headers.get("HX-Request"):
+                # the file can't be swapped into the page, the browser downloads it with a normal request
+                response = HttpResponse()
+                response["HX-Redirect"] = self.admit_export()
+                return response
+            if admitted:
+                # one download per token
+                caches[self.export_cache_alias].delete(self.get_export_admission_key())
+            return super().get(request, *args, **kwargs)
+        finally:
+            for semaphore, token in reversed(acquired):
+                semaphore.release(token)
+
+    def get_export_cache_key(self):
+        """
+        Returns the parts identifying the export file of the current request.
+
+        The path covers URL kwargs (e.g. a filter by school). Unless export_cache_per_user is False, every user gets
+        their own files, so querysets scoped to the user never leak. Overwrite this for other scopes.
+        """
+        view_name = f"{self.__class__.__module__}.{self.__class__.__qualname__}"
+        cache_key = [
+            view_name,
+            self.request.path,
+            self.extension,
+            self.get_export_query_string(),
+        ]
+        if self.export_cache_per_user:
+            user = getattr(self.request, "user", None)
+            cache_key.append(
+                str(user.pk) if user is not None and user.is_authenticated else ""
+            )
+        return cache_key
+
+    def get_export_file_path(self):
+        """
+        Returns the path of the cached export file for the current request.
+        """
+        cache_key = hashlib.sha1(
+            "|".join(self.get_export_cache_key()).encode("utf-8")
+        ).hexdigest()
+        return os.path.join(
+            os.fspath(self.export_directory), f"{cache_key}.{self.extension}"
+        )
+
+    def is_export_file_fresh(self, file_path):
+        try:
+            modified = os.path.getmtime(file_path)
+        except OSError:
+            return False
+        return time.time() - modified < self.export_max_age
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["file_name"] = self.get_file_name()
-        context["file_data"] = self.get_file_data(context["object_list"])
         context["file_content_type"] = self.get_file_content_type()
+
+        if self.export_directory:
+            file_path = self.get_export_file_path()
+            if not self.is_export_file_fresh(file_path):
+                with timed_phase(self.request, "export"):
+                    file_data = self.get_file_data(context["object_list"])
+                    write_export_file(file_path, file_data)
+                remove_expired_export_files(
+                    os.fspath(self.export_directory), self.export_max_age
+                )
+            context["file_path"] = file_path
+        else:
+            with timed_phase(self.request, "export"):
+                context["file_data"] = self.get_file_data(context["object_list"])
+
         return context
 
+    def get_sendfile_response(self, file_path):
+        file_name = os.path.basename(file_path)
+        response = HttpResponse()
+        if self.export_sendfile_header == "X-Accel-Redirect":
+            prefix = self.export_sendfile_prefix or "/"
+            response[self.export_sendfile_header] = f"{prefix.rstrip('/')}/{file_name}"
+        else:
+            response[self.export_sendfile_header] = file_path
+        return response
+
+    def get_file_response(self, file_path):
+        """
+        Serves an export file from disk, honoring a single byte "Range" from the request.
+        """
+        file_stat = os.stat(file_path)
+        file_size = file_stat.st_size
+        last_modified = http_date(file_stat.st_mtime)
+
+        byte_range = None
+        range_header = self.request.headers.get("Range")
+        if_range = self.request.headers.get("If-Range")
+        if range_header and (
+            not if_range or parse_http_date_safe(if_range) == int(file_stat.st_mtime)
+        ):
+            try:
+                byte_range = get_byte_range(range_header, file_size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response["Content-Range"] = f"bytes */{file_size}"
+                return response
+
+        if byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                read_file_range(file_path, start, end), status=206
+            )
+            response["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+            response["Content-Length"] = str(end - start + 1)
+        else:
+            response = FileResponse(open(file_path, "rb"))
+            response["Content-Length"] = str(file_size)
+
+        response["Accept-Ranges"] = "bytes"
+        response["Last-Modified"] = last_modified
+        return response
+
     def render_to_response(self, context, **response_kwargs):
         headers = {
             "Content-Type": context["file_content_type"],
             "Content-Disposition": f'attachment; filename="{context["file_name"]}"',
         }
 
-        response = HttpResponse(content=context["file_data"])
+        if "file_path" in context and self.export_sendfile_header:
+            response = self.get_sendfile_response(context["file_path"])
+        elif "file_path" in context:
+            response = self.get_file_response(context["file_path"])
+        else:
+            response = HttpResponse(content=context["file_data"])
+
         for key, value in headers.items():
             response[key] = value
 
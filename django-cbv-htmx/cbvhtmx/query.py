@@ -0,0 +1,277 @@
+# cbvhtmx\query.py
+import re
+
+from django.core.exceptions import (
+    FieldDoesNotExist,
+    ImproperlyConfigured,
+    ValidationError,
+)
+from django.db import models
+from django.db.models import Q
+
+TEXT = "text"
+TYPED = "typed"
+LIST = "list"
+CUSTOM = "custom"
+
+TEXT_FIELDS = (models.CharField, models.TextField)
+RANGE_FIELDS = (
+    models.IntegerField,
+    models.FloatField,
+    models.DecimalField,
+    models.DateField,
+    models.TimeField,
+    models.DurationField,
+)
+RANGE_SEPARATOR = ".."
+
+# field:value, field:"quoted phrase", "quoted phrase" or word
+_token_pattern = re.compile(
+    r'(?:(?P<alias>\w+):)?(?:"(?P<phrase>[^"]*)"|(?P<word>\S+))'
+)
+
+
+def resolve_field_path(model, field_path):
+    """
+    Follows a field path ("tags__name__in") through the model relations.
+
+    :param model: the Django model the path starts at
+    :param str field_path: a field name or query string
+    :return: tuple (model, field, lookup, multi_valued) where model is the model holding the final field, lookup is
+    None if the path doesn't end in a lookup and multi_valued is True if the path crosses a to-many relation
+    :raises FieldDoesNotExist: if the first part of the path isn't a field
+    """
+    parts = field_path.split("__")
+    current_model = model
+    field = None
+    multi_valued = False
+    for index, part in enumerate(parts):
+        try:
+            field = current_model._meta.get_field(part)
+        except FieldDoesNotExist:
+            if field is None:
+                raise
+            return current_model, field, "__".join(parts[index:]), multi_valued
+        if field.is_relation and field.related_model and index < len(parts) - 1:
+            multi_valued = multi_valued or bool(field.many_to_many or field.one_to_many)
+            current_model = field.related_model
+    return current_model, field, None, multi_valued
+
+
+class QueryField:
+    """
+    A compiled entry of a view's query_fields.
+
+    The kind decides how a search value is turned into a filter:
+    - TEXT: text fields, filtered with the configured lookup (icontains unless overwritten)
+    - TYPED: all other concrete fields, the value is converted with the field's to_python() and compared exactly;
+    ordered fields (numbers, dates) also accept ranges written as "start..end", "start.." or "..end"
+    - LIST: entries ending in "__in", the value is inserted into a list
+    - CUSTOM: entries with any other lookup, or query strings across relations without one ("tags__name", compared
+    exactly), the value is passed as-is
+    """
+
+    def __init__(self, model, entry, lookup=None):
+        if not isinstance(entry, str):
+            raise ImproperlyConfigured(
+                f"query_fields entries must be strings, got {entry!r}"
+            )
+
+        try:
+            target_model, field, entry_lookup, multi_valued = resolve_field_path(
+                model, entry
+            )
+        except FieldDoesNotExist:
+            raise ImproperlyConfigured(
+                f"query_fields entry '{entry}' isn't a field of {model._meta.label}"
+            )
+
+        self.entry = entry
+        self.field = field
+        self.multi_valued = multi_valued
+        self.path = entry[: -len(entry_lookup) - 2] if entry_lookup else entry
+        self.aliases = {self.path, self.path.split("__")[0]}
+
+        if entry_lookup:
+            self.lookup = entry_lookup
+            self.kind = LIST if entry_lookup.split("__")[-1] == "in" else CUSTOM
+        elif "__" in entry and not lookup:
+            # query strings across relations are passed through as written, i.e. compared exactly
+            self.lookup = "exact"
+            self.kind = CUSTOM
+        elif field.is_relation:
+            raise ImproperlyConfigured(
+                f"query_fields entry '{entry}' is a relation, query one of its fields (e.g. '{entry}__name')"
+            )
+        elif isinstance(field, TEXT_FIELDS):
+            self.lookup = lookup or "icontains"
+            self.kind = TEXT
+        else:
+            self.lookup = lookup or "exact"
+            self.kind = TYPED
+
+        if lookup and entry_lookup:
+            raise ImproperlyConfigured(
+                f"query_fields entry '{entry}' already contains a lookup, it can't be set in query_lookups"
+            )
+        if self.kind in (TEXT, TYPED) and not self.get_field_lookup(self.lookup):
+            raise ImproperlyConfigured(
+                f"Unsupported lookup '{self.lookup}' for query_fields entry '{entry}'"
+            )
+
+    def get_field_lookup(self, lookup):
+        if isinstance(self.field, models.DateTimeField) and lookup.startswith("date"):
+            return True
+        return self.field.get_lookup(lookup.split("__")[0]) is not None
+
+    @property
+    def supports_range(self):
+        return self.kind == TYPED and isinstance(self.field, RANGE_FIELDS)
+
+    def to_python(self, value):
+        """
+        Converts a search value for the field. Raises ValidationError if the value doesn't fit the field.
+        """
+        if isinstance(self.field, models.DateTimeField):
+            # searching a datetime by day is more useful than by the exact second
+            return models.DateField().to_python(value)
+        return self.field.to_python(value)
+
+    def get_filter_path(self, lookup):
+        if isinstance(self.field, models.DateTimeField) and self.kind == TYPED:
+            return f"{self.path}__date__{lookup}"
+        return f"{self.path}__{lookup}"
+
+    def build_q(self, value):
+        """
+        Builds the filter for a single search value.
+
+        :param str value: the search value
+        :return: Q object or None if the value can't match this field
+        """
+        if self.kind == LIST:
+            return Q(**{self.entry: [value]})
+        if self.kind == CUSTOM:
+            return Q(**{self.entry: value})
+        if self.kind == TEXT:
+            return Q(**{self.get_filter_path(self.lookup): value})
+
+        try:
+            if self.supports_range and RANGE_SEPARATOR in value:
+                start, end = value.split(RANGE_SEPARATOR, 1)
+                range_q = Q()
+                if start:
+                    range_q &= Q(**{self.get_filter_path("gte"): self.to_python(start)})
+                if end:
+                    range_q &= Q(**{self.get_filter_path("lte"): self.to_python(end)})
+                return range_q or None
+            return Q(**{self.get_filter_path(self.lookup): self.to_python(value)})
+        except (ValidationError, ValueError, TypeError):
+            return None
+
+
+class QuerySpec:
+    """
+    The compiled query_fields of a view.
+
+    A search string is split into tokens: words, "quoted phrases" and field:value tokens (the field being the name of
+    a query field or its first relation, e.g. "tags:foo"). Every token must match (AND), a free token may match any
+    of the query fields (OR), a field token only its fields. Tokens with an unknown field name are searched as free
+    words, so values like MAC addresses keep working.
+    """
+
+    def __init__(self, model, query_fields, query_lookups=None):
+        query_lookups = query_lookups or {}
+        unknown_lookups = set(query_lookups) - set(query_fields)
+        if unknown_lookups:
+            raise ImproperlyConfigured(
+                f"query_lookups contains fields missing from query_fields: {', '.join(sorted(unknown_lookups))}"
+            )
+
+        self.model = model
+        self.fields = [
+            QueryField(model, entry, query_lookups.get(entry)) for entry in query_fields
+        ]
+        self.aliases = {}
+        for query_field in self.fields:
+            for alias in query_field.aliases:
+                self.aliases.setdefault(alias, []).append(query_field)
+        self.needs_distinct = any(
+            query_field.multi_valued for query_field in self.fields
+        )
+
+    def parse(self, query):
+        """
+        Splits a search string into tokens.
+
+        :param str query: the search string
+        :return: list of tuples (alias, value), alias is None for free tokens
+        """
+        tokens = []
+        for match in _token_pattern.finditer(query):
+            alias = match.group("alias")
+            value = (
+                match.group("phrase")
+                if match.group("phrase") is not None
+                else match.group("word")
+            )
+            if alias and alias not in self.aliases:
+                alias = None
+                value = match.group(0).replace('"', "")
+            value = value.strip()
+            if value:
+                tokens.append((alias, value))
+        return tokens
+
+    def build_filters(self, query):
+        """
+        Builds one filter per token of a search string.
+
+        :param str query: the search string
+        :return: list of Q objects, a token matching no field produces a filter without results
+        """
+        token_filters = []
+        for alias, value in self.parse(query):
+            query_fields = self.aliases[alias] if alias else self.fields
+            token_filter = Q()
+            for query_field in query_fields:
+                field_filter = query_field.build_q(value)
+                if field_filter is not None:
+                    token_filter |= field_filter
+            if not token_filter:
+                return [Q(pk__in=[])]
+            token_filters.append(token_filter)
+        return token_filters
+
+    def build_q(self, query):
+        """
+        Builds the filter for a search string as a single Q object.
+
+        Across to-many relations all tokens would have to match the same related row, use filter_queryset() there.
+
+        :param str query: the search string
+        :return: Q object
+        """
+        q_filter = Q()
+        for token_filter in self.build_filters(query):
+            q_filter &= token_filter
+        return q_filter
+
+    def filter_queryset(self, queryset, query):
+        """
+        Filters a queryset by a search string.
+
+        If a query field crosses a to-many relation, every token is applied in its own filter() call, so "tags:rock
+        tags:jazz" finds objects having both tags instead of a single tag named both. The result is made distinct.
+
+        :param django.db.models.query.QuerySet queryset: the queryset to filter
+        :param str query: the search string
+        :return: QuerySet
+        """
+        if not self.needs_distinct:
+            return queryset.filter(self.build_q(query))
+
+        for token_filter in self.build_filters(query):
+            queryset = queryset.filter(token_filter)
+        # only to-many relations can duplicate rows
+        return queryset.distinct()
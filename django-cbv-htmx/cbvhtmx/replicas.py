@@ -0,0 +1,85 @@
+# cbvhtmx\replicas.py
+import contextvars
+import time
+
+from django.conf import settings
+
+# the write flag of the current request, None outside of ReplicaMiddleware
+_request_writes = contextvars.ContextVar("cbvhtmx_request_writes", default=None)
+
+SESSION_KEY = "_cbvhtmx_primary_until"
+IGNORED_APP_LABELS = ("sessions",)
+
+
+def get_replica_alias():
+    return getattr(settings, "CBVHTMX_REPLICA_DATABASE", None)
+
+
+def get_read_database(request):
+    """
+    Returns the database alias the request's list, search and export reads should use.
+
+    Reads go to the replica (setting CBVHTMX_REPLICA_DATABASE) for GET and HEAD requests, unless the session wrote to
+    the primary within the last CBVHTMX_REPLICA_STICKY_SECONDS (read-your-writes).
+
+    :return: the replica alias or None for the default routing
+    """
+    replica_alias = get_replica_alias()
+    if not replica_alias or request.method not in ("GET", "HEAD"):
+        return None
+    session = getattr(request, "session", None)
+    if session is not None and session.get(SESSION_KEY, 0) > time.time():
+        return None
+    return replica_alias
+
+
+def using_read_database(request, queryset):
+    """
+    Routes a queryset to the request's read database.
+    """
+    read_database = get_read_database(request)
+    if read_database is None or queryset._db is not None:
+        # querysets routed explicitly by the view are left alone
+        return queryset
+    return queryset.using(read_database)
+
+
+class ReplicaRouter:
+    """
+    A database router recording writes, so sessions that just wrote read from the primary for a while.
+
+    It doesn't route reads itself, the cbvhtmx mixins send their querysets to the replica (see get_read_database).
+    Add it to DATABASE_ROUTERS together with ReplicaMiddleware.
+    """
+
+    def db_for_write(self, model, **hints):
+        request_writes = _request_writes.get()
+        if (
+            request_writes is not None
+            and model._meta.app_label not in IGNORED_APP_LABELS
+        ):
+            request_writes["wrote"] = True
+        return None
+
+
+class ReplicaMiddleware:
+    """
+    Pins a session to the primary database after it wrote. Must come after SessionMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _request_writes.set({"wrote": False})
+        try:
+            response = self.get_response(request)
+            wrote = _request_writes.get()["wrote"]
+        finally:
+            _request_writes.reset(token)
+
+        session = getattr(request, "session", None)
+        if wrote and session is not None:
+            sticky_seconds = getattr(settings, "CBVHTMX_REPLICA_STICKY_SECONDS", 5)
+            session[SESSION_KEY] = time.time() + sticky_seconds
+        return response
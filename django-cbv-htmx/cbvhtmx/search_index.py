@@ -0,0 +1,372 @@
+# cbvhtmx\search_index.py
+import logging
+import re
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from .query import CUSTOM, LIST, TEXT, TYPED
+
+logger = logging.getLogger(__name__)
+
+_word_pattern = re.compile(r"\w+")
+_document_separator = "\x00"
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_ngrams(text, size):
+    """
+    Returns the set of n-grams of every word in a text. Words shorter than the n-gram size have none.
+    """
+    ngrams = set()
+    for word in _word_pattern.findall(text):
+        if len(word) >= size:
+            ngrams.update(
+                word[index : index + size] for index in range(len(word) - size + 1)
+            )
+    return ngrams
+
+
+def insert_sorted(postings, pk):
+    index = bisect_left(postings, pk)
+    if index == len(postings) or postings[index] != pk:
+        postings.insert(index, pk)
+
+
+def remove_sorted(postings, pk):
+    index = bisect_left(postings, pk)
+    if index < len(postings) and postings[index] == pk:
+        del postings[index]
+
+
+def intersect_sorted(first, second):
+    """
+    Intersects two sorted posting lists.
+    """
+    if len(first) > len(second):
+        first, second = second, first
+    result = array("q")
+    for pk in first:
+        index = bisect_left(second, pk)
+        if index < len(second) and second[index] == pk:
+            result.append(pk)
+    return result
+
+
+class SearchIndexUnavailable(Exception):
+    """
+    Raised if a search index can't answer a query (over its memory budget or unsupported query).
+    """
+
+
+class SearchIndex:
+    """
+    An in-process inverted index over the text fields of a QuerySpec.
+
+    Text fields searched with "icontains" are indexed by n-grams: a search word is looked up through the posting lists
+    of its n-grams and the candidates are verified against the stored text. Fields searched with "__in" (e.g. tag
+    names) are indexed by their exact value. Posting lists are sorted arrays of integer primary keys.
+
+    The index is built on the first search (or by calling build()) and kept in sync by save, delete and m2m signals.
+    Changes to related objects themselves (e.g. renaming a tag) aren't tracked, call rebuild() for those.
+    The index lives in one process and only sees the signals of that process: with several workers, changes made by
+    the others only show up once the index is rebuilt, which happens on the first search after max_age seconds.
+    If the index outgrows its memory budget it is dropped and searches raise SearchIndexUnavailable, so callers fall
+    back to the database.
+    """
+
+    def __init__(
+        self, query_spec, memory_budget=64 * 1024 * 1024, ngram_size=3, max_age=300
+    ):
+        if not self.is_supported(query_spec):
+            raise SearchIndexUnavailable(
+                f"{query_spec.model._meta.label}: only icontains and __in query fields can be indexed"
+            )
+        self.query_spec = query_spec
+        self.model = query_spec.model
+        self.memory_budget = memory_budget
+        self.ngram_size = ngram_size
+        self.max_age = max_age
+        self.built_at = None
+        self.text_fields = [field for field in query_spec.fields if field.kind == TEXT]
+        self.list_fields = [field for field in query_spec.fields if field.kind == LIST]
+
+        self.lock = threading.RLock()
+        self.built = False
+        self.over_budget = False
+        self.clear()
+        self.connect_signals()
+
+    @staticmethod
+    def is_supported(query_spec):
+        if query_spec.model._meta.pk.get_internal_type() not in (
+            "AutoField",
+            "BigAutoField",
+            "SmallAutoField",
+            "IntegerField",
+            "BigIntegerField",
+        ):
+            return False
+        for query_field in query_spec.fields:
+            if query_field.kind == TEXT and query_field.lookup != "icontains":
+                return False
+            if query_field.kind in (TYPED, CUSTOM):
+                return False
+            if query_field.kind == LIST and query_field.lookup != "in":
+                return False
+        return True
+
+    def clear(self):
+        self.documents = {}
+        self.document_values = {}
+        self.ngram_postings = {}
+        self.value_postings = {}
+        self.memory_size = 0
+
+    def connect_signals(self):
+        dispatch_uid = f"cbvhtmx_search_index_{id(self)}"
+        post_save.connect(
+            self._handle_save, sender=self.model, dispatch_uid=dispatch_uid, weak=False
+        )
+        post_delete.connect(
+            self._handle_delete,
+            sender=self.model,
+            dispatch_uid=dispatch_uid,
+            weak=False,
+        )
+        for query_field in self.query_spec.fields:
+            relation = self.model._meta.get_field(query_field.path.split("__")[0])
+            through = (
+                getattr(relation.remote_field, "through", None)
+                if relation.is_relation
+                else None
+            )
+            if through is not None:
+                m2m_changed.connect(
+                    self._handle_m2m,
+                    sender=through,
+                    dispatch_uid=dispatch_uid,
+                    weak=False,
+                )
+
+    def _handle_save(self, sender, instance, **kwargs):
+        pk = instance.pk
+        transaction.on_commit(lambda: self.update([pk]))
+
+    def _handle_delete(self, sender, instance, **kwargs):
+        pk = instance.pk
+        transaction.on_commit(lambda: self.update([pk], deleted=True))
+
+    def _handle_m2m(self, sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ("post_add", "post_remove", "post_clear"):
+            return
+        if not reverse and isinstance(instance, self.model):
+            pks = [instance.pk]
+            transaction.on_commit(lambda: self.update(pks))
+        elif pk_set:
+            pks = list(pk_set)
+            transaction.on_commit(lambda: self.update(pks))
+        elif action == "post_clear":
+            # the affected objects are unknown once the relation is cleared
+            transaction.on_commit(self.rebuild)
+
+    def read_values(self, pks=None):
+        """
+        Reads the searchable values from the database.
+
+        :param pks: only read these objects (all if None)
+        :return: tuple (texts, values): dictionaries pk -> list of text values and pk -> set of list values
+        """
+        # ascending keys are appended to the posting lists instead of shifting them
+        queryset = self.model._default_manager.order_by("pk")
+        if pks is not None:
+            queryset = queryset.filter(pk__in=list(pks))
+
+        texts = {}
+        for pk in queryset.values_list("pk", flat=True).iterator():
+            texts[pk] = []
+        values = {pk: set() for pk in texts}
+
+        # every field is a query of its own, objects created in between are added by whichever query sees them first
+        for query_field in self.text_fields:
+            for pk, value in queryset.values_list("pk", query_field.path).iterator():
+                text_values = texts.setdefault(pk, [])
+                values.setdefault(pk, set())
+                if value:
+                    text_values.append(str(value).lower())
+        for query_field in self.list_fields:
+            for pk, value in queryset.values_list("pk", query_field.path).iterator():
+                list_values = values.setdefault(pk, set())
+                texts.setdefault(pk, [])
+                if value is not None:
+                    list_values.add(str(value))
+        return texts, values
+
+    def add_document(self, pk, text_values, list_values):
+        text = _document_separator.join(text_values)
+        self.documents[pk] = text
+        self.document_values[pk] = list_values
+        self.memory_size += sys.getsizeof(text) + 8 * len(list_values)
+        for ngram in get_ngrams(text, self.ngram_size):
+            postings = self.ngram_postings.get(ngram)
+            if postings is None:
+                postings = self.ngram_postings[ngram] = array("q")
+                self.memory_size += sys.getsizeof(ngram) + sys.getsizeof(postings)
+            insert_sorted(postings, pk)
+            self.memory_size += postings.itemsize
+        for value in list_values:
+            postings = self.value_postings.get(value)
+            if postings is None:
+                postings = self.value_postings[value] = array("q")
+                self.memory_size += sys.getsizeof(value) + sys.getsizeof(postings)
+            insert_sorted(postings, pk)
+            self.memory_size += postings.itemsize
+
+    def remove_document(self, pk):
+        text = self.documents.pop(pk, None)
+        if text is None:
+            return
+        list_values = self.document_values.pop(pk, set())
+        self.memory_size -= sys.getsizeof(text) + 8 * len(list_values)
+        for ngram in get_ngrams(text, self.ngram_size):
+            postings = self.ngram_postings.get(ngram)
+            if postings is not None:
+                remove_sorted(postings, pk)
+                self.memory_size -= postings.itemsize
+        for value in list_values:
+            postings = self.value_postings.get(value)
+            if postings is not None:
+                remove_sorted(postings, pk)
+                self.memory_size -= postings.itemsize
+
+    def check_budget(self):
+        if self.memory_size > self.memory_budget:
+            logger.warning(
+                f"Search index for {self.model._meta.label} exceeds its memory budget "
+                f"({self.memory_size} > {self.memory_budget} bytes), falling back to the database."
+            )
+            self.clear()
+            self.over_budget = True
+            return False
+        return True
+
+    def build(self):
+        with self.lock:
+            self.clear()
+            self.over_budget = False
+            texts, values = self.read_values()
+            for pk, text_values in texts.items():
+                self.add_document(pk, text_values, values[pk])
+                if self.memory_size > self.memory_budget:
+                    break
+            self.built = self.check_budget()
+            self.built_at = time.monotonic()
+
+    def is_expired(self):
+        return (
+            self.max_age is not None
+            and self.built_at is not None
+            and time.monotonic() - self.built_at > self.max_age
+        )
+
+    def rebuild(self):
+        with self.lock:
+            if self.built:
+                self.build()
+
+    def update(self, pks, deleted=False):
+        with self.lock:
+            if not self.built:
+                return
+            for pk in pks:
+                self.remove_document(pk)
+            if not deleted:
+                texts, values = self.read_values(pks)
+                for pk, text_values in texts.items():
+                    self.add_document(pk, text_values, values[pk])
+            self.built = self.check_budget()
+
+    def search_word(self, word):
+        lowered = word.lower()
+        candidates = None
+        for ngram in get_ngrams(lowered, self.ngram_size):
+            postings = self.ngram_postings.get(ngram, array("q"))
+            candidates = (
+                postings
+                if candidates is None
+                else intersect_sorted(candidates, postings)
+            )
+            if not candidates:
+                break
+
+        if candidates is None:
+            # only words shorter than the n-grams, only a scan can answer this
+            candidates = self.documents.keys()
+        matches = {pk for pk in candidates if lowered in self.documents[pk]}
+        matches.update(self.value_postings.get(word, ()))
+        return matches
+
+    def search(self, query):
+        """
+        Returns the primary keys of all objects matching a search string.
+
+        :param str query: the search string (parsed like QuerySpec.parse)
+        :return: set of primary keys
+        :raises SearchIndexUnavailable: if the index is over its budget or the query uses field tokens
+        """
+        tokens = self.query_spec.parse(query)
+        if any(alias for alias, _ in tokens):
+            raise SearchIndexUnavailable(
+                "field:value tokens are answered by the database"
+            )
+
+        with self.lock:
+            if (not self.built and not self.over_budget) or self.is_expired():
+                # an index over its budget is retried once it expires, the table may have shrunk
+                self.build()
+            if self.over_budget:
+                raise SearchIndexUnavailable(
+                    f"Search index for {self.model._meta.label} is over its budget"
+                )
+
+            result = None
+            for _, value in tokens:
+                matches = self.search_word(value)
+                result = matches if result is None else result & matches
+                if not result:
+                    return set()
+            return set(self.documents) if result is None else result
+
+
+def get_search_index(query_spec, **options):
+    """
+    Returns the shared search index of a QuerySpec, creating it on first use.
+    """
+    key = (
+        query_spec.model._meta.label_lower,
+        tuple(field.entry for field in query_spec.fields),
+    )
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = SearchIndex(query_spec, **options)
+        return _registry[key]
+
+
+def update_search_indexes(model, pks):
+    """
+    Updates the objects in every search index of a model, for changes made without signals (e.g. QuerySet.update()).
+    """
+    with _registry_lock:
+        search_indexes = [
+            search_index
+            for search_index in _registry.values()
+            if search_index.model == model
+        ]
+    for search_index in search_indexes:
+        search_index.update(pks)
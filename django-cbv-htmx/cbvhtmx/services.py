@@ -3,6 +3,10 @@ import codecs
 import csv
 import io
 import logging
+import os
+import re
+import tempfile
+import time
 
 from pandas.tests.io.excel.test_xlsxwriter import xlsxwriter
 
@@ -66,6 +70,130 @@ def read_objects_into_xlsx(query_set, export_fields):
     return bytes_object.getvalue()
 
 
+# mkstemp creates files readable by the owner only, the web server (X-Sendfile) may run as another user
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def write_export_file(file_path, file_data):
+    """
+    Writes finished export data to disk.
+
+    The data is written to a temporary file in the same directory first and then moved into place, so a concurrent
+    request never serves a half-written file.
+
+    :param str file_path: absolute path of the export file
+    :param bytes file_data: byte-string of the export output
+    :return: the file path
+    """
+    directory = os.path.dirname(file_path)
+    os.makedirs(directory, exist_ok=True)
+
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(file_descriptor, "wb") as temp_file:
+            temp_file.write(file_data)
+        os.chmod(temp_path, 0o666 & ~_umask)
+        os.replace(temp_path, file_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return file_path
+
+
+def remove_expired_export_files(directory, max_age):
+    """
+    Deletes export files (and leftover temporary files) older than max_age seconds from a directory.
+
+    :param str directory: the export directory
+    :param int max_age: the age in seconds after which files are removed
+    :return: the number of removed files
+    """
+    expired_before = time.time() - max_age
+    removed = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < expired_before:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            # removed by a concurrent request
+            continue
+    return removed
+
+
+_range_pattern = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def get_byte_range(range_header, file_size):
+    """
+    Reads a single byte range from an HTTP Range header.
+
+    Multiple ranges and units other than bytes are not supported; for those None is returned and the whole file
+    should be served (which is allowed by RFC 7233).
+
+    :param str range_header: the value of the Range header
+    :param int file_size: size of the file in bytes
+    :return: tuple (start, end) with an inclusive end, or None if the header should be ignored
+    :raises ValueError: if the range can't be satisfied for the file (respond with 416)
+    """
+    match = _range_pattern.match(range_header.strip())
+    if not match:
+        return None
+
+    start_str, end_str = match.groups()
+    if not start_str and not end_str:
+        return None
+    if file_size == 0:
+        raise ValueError(f"Unsatisfiable range: {range_header}")
+
+    if not start_str:
+        # suffix range: the last n bytes
+        suffix_length = int(end_str)
+        if suffix_length == 0:
+            raise ValueError(f"Unsatisfiable range: {range_header}")
+        start = max(file_size - suffix_length, 0)
+        end = file_size - 1
+    else:
+        start = int(start_str)
+        if start >= file_size:
+            raise ValueError(f"Unsatisfiable range: {range_header}")
+        end = int(end_str) if end_str else file_size - 1
+        if end < start:
+            return None
+        end = min(end, file_size - 1)
+
+    return start, end
+
+
+def read_file_range(file_path, start, end, chunk_size=64 * 1024):
+    """
+    Yields the bytes of a file between start and end (inclusive).
+
+    :param str file_path: path of the file
+    :param int start: first byte position
+    :param int end: last byte position
+    :param int chunk_size: maximum size of each yielded chunk
+    :return: generator of byte-strings
+    """
+    remaining = end - start + 1
+    with open(file_path, "rb") as file_object:
+        file_object.seek(start)
+        while remaining > 0:
+            chunk = file_object.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
 def get_value_list(export_fields, model_entry):
     """
 
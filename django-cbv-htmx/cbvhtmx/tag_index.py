@@ -0,0 +1,163 @@
+# cbvhtmx\tag_index.py
+import heapq
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+from django.db.models import Count
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class TagPrefixIndex:
+    """
+    A sorted in-memory index of the tag names used by a model, for autocompletion.
+
+    Names are kept lowercased and interned in a sorted list, so a prefix is found by binary search. Suggestions are
+    ranked by how many objects of the model use the tag.
+
+    Adding and removing tags (taggit's m2m_changed signals) updates the counts in place. Other changes (clearing
+    tags, renaming or deleting tags, deleting tagged objects) mark the index as stale and it is rebuilt on the next
+    lookup. The signals only reach the index of the process that made the change, so suggest() also rebuilds an
+    index older than its max_age, for the changes of other workers.
+    """
+
+    def __init__(self, model, tags_field="tags", tag_name_field="name"):
+        self.model = model
+        self.tags_field = tags_field
+        self.tag_name_field = tag_name_field
+
+        relation = model._meta.get_field(tags_field)
+        self.tag_model = relation.related_model
+        self.through = relation.remote_field.through
+
+        self.lock = threading.RLock()
+        self.stale = True
+        self.built_at = None
+        self.keys = []
+        self.names = {}
+        self.counts = {}
+        self.tag_names = {}
+        self.connect_signals()
+
+    def connect_signals(self):
+        dispatch_uid = f"cbvhtmx_tag_index_{id(self)}"
+        m2m_changed.connect(
+            self._handle_m2m, sender=self.through, dispatch_uid=dispatch_uid, weak=False
+        )
+        for sender in (self.tag_model, self.model):
+            post_delete.connect(
+                self._mark_stale, sender=sender, dispatch_uid=dispatch_uid, weak=False
+            )
+        post_save.connect(
+            self._mark_stale,
+            sender=self.tag_model,
+            dispatch_uid=dispatch_uid,
+            weak=False,
+        )
+
+    def _mark_stale(self, **kwargs):
+        self.stale = True
+
+    def _handle_m2m(self, sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ("post_add", "post_remove", "post_clear"):
+            return
+        if (
+            action == "post_clear"
+            or reverse
+            or not isinstance(instance, self.model)
+            or not pk_set
+        ):
+            self.stale = True
+            return
+
+        change = 1 if action == "post_add" else -1
+        with self.lock:
+            if self.stale:
+                return
+            for tag_pk in pk_set:
+                name = self.tag_names.get(tag_pk)
+                if name is None:
+                    # a tag this index hasn't seen yet
+                    self.stale = True
+                    return
+                self.counts[name] = max(self.counts.get(name, 0) + change, 0)
+
+    def build(self):
+        with self.lock:
+            tag_names = dict(
+                self.tag_model._default_manager.values_list("pk", self.tag_name_field)
+            )
+            name_path = f"{self.tags_field}__{self.tag_name_field}"
+            counts = {
+                entry[name_path]: entry["usage"]
+                for entry in self.model._default_manager.order_by()
+                .exclude(**{f"{name_path}__isnull": True})
+                .values(name_path)
+                .annotate(usage=Count("pk"))
+            }
+
+            names = {}
+            for name in tag_names.values():
+                names.setdefault(sys.intern(name.lower()), []).append(sys.intern(name))
+            self.keys = sorted(names)
+            self.names = names
+            self.counts = {name: counts.get(name, 0) for name in tag_names.values()}
+            self.tag_names = tag_names
+            self.stale = False
+            self.built_at = time.monotonic()
+
+    def suggest(self, prefix, limit=10, max_age=None):
+        """
+        Returns the most used tag names starting with a prefix (case-insensitive).
+
+        :param str prefix: the typed prefix
+        :param int limit: the maximum number of suggestions
+        :param max_age: the seconds after which the index is rebuilt (None to rely on the signals only)
+        :return: list of tuples (name, usage count)
+        """
+        prefix = prefix.strip().lower()
+        with self.lock:
+            if self.stale or (
+                max_age is not None and time.monotonic() - self.built_at > max_age
+            ):
+                self.build()
+
+            matches = []
+            index = bisect_left(self.keys, prefix)
+            while index < len(self.keys) and self.keys[index].startswith(prefix):
+                for name in self.names[self.keys[index]]:
+                    matches.append((self.counts.get(name, 0), name))
+                index += 1
+
+        # most used first, alphabetically on ties
+        return [
+            (name, count)
+            for count, name in heapq.nsmallest(
+                limit, matches, key=lambda match: (-match[0], match[1])
+            )
+        ]
+
+
+def get_tag_index(model, tags_field="tags", tag_name_field="name"):
+    """
+    Returns the shared tag index of a model's tags field, creating it on first use.
+    """
+    key = (model._meta.label_lower, tags_field, tag_name_field)
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = TagPrefixIndex(model, tags_field, tag_name_field)
+        return _registry[key]
+
+
+def mark_tag_indexes_stale(model):
+    """
+    Marks every tag index of a model as stale, for tags changed without signals (e.g. bulk inserts).
+    """
+    with _registry_lock:
+        for tag_index in _registry.values():
+            if tag_index.model == model:
+                tag_index.stale = True
@@ -0,0 +1,67 @@
+# /templatetags/row_cache.py
+
+from django import template
+from django.core.cache import caches
+
+from ..tools import get_row_cache_key
+
+register = template.Library()
+
+
+class RowCacheNode(template.Node):
+    def __init__(self, nodelist, row_object, fragment_name, vary_on):
+        self.nodelist = nodelist
+        self.row_object = row_object
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        row_object = self.row_object.resolve(context)
+        fragment_name = self.fragment_name.resolve(context)
+        view = context.get("view")
+        if hasattr(view, "get_row_cache_key"):
+            # RowCacheMixin preloads the fragments, its key must be used for them to be found
+            if self.vary_on:
+                raise template.TemplateSyntaxError(
+                    "'cache_row' takes no vary_on arguments in views using RowCacheMixin, "
+                    "override the view's get_row_cache_vary_on() instead."
+                )
+            cache_key = view.get_row_cache_key(row_object, fragment_name)
+        else:
+            vary_on = [variable.resolve(context) for variable in self.vary_on]
+            cache_key = get_row_cache_key(row_object, fragment_name, vary_on)
+        preloaded_fragments = context.get("row_cache_fragments") or {}
+        if cache_key in preloaded_fragments:
+            return preloaded_fragments[cache_key]
+
+        cache = caches[getattr(view, "row_cache_alias", "default")]
+        fragment = cache.get(cache_key)
+        if fragment is None:
+            fragment = self.nodelist.render(context)
+            cache.set(cache_key, fragment, getattr(view, "row_cache_timeout", 300))
+        return fragment
+
+
+@register.tag(name="cache_row")
+def cache_row(parser, token):
+    """
+    Caches the rendered HTML of a table row.
+
+    Usage: {% cache_row object "fragment name" [vary_on ...] %} ... {% endcache_row %}
+
+    The key is built from the object's model and pk, the fragment name and the vary_on values (e.g. object.updated).
+    In views using RowCacheMixin the key comes from the view's get_row_cache_key() and vary_on must be left out.
+    """
+    nodelist = parser.parse(("endcache_row",))
+    parser.delete_first_token()
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(
+            f"'{bits[0]}' tag requires at least 2 arguments."
+        )
+    return RowCacheNode(
+        nodelist,
+        parser.compile_filter(bits[1]),
+        parser.compile_filter(bits[2]),
+        [parser.compile_filter(bit) for bit in bits[3:]],
+    )
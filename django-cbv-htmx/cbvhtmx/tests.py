@@ -1,3 +1,393 @@
-from django.test import TestCase
+# cbvhtmx\tests.py
+import os
+import tempfile
+import time
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.http import HttpResponse
+from django.test import (
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.utils.http import http_date
+from django.views.generic import ListView
+
+from .mixins import ExportMixin, OrderingMixin
+from .query import QuerySpec
+from .replicas import (
+    SESSION_KEY,
+    ReplicaMiddleware,
+    get_read_database,
+    using_read_database,
+)
+from .search_index import SearchIndex, SearchIndexUnavailable
+from .services import get_byte_range
+
+
+class UserListView(OrderingMixin, ListView):
+    model = User
+
+
+class SessionRequestMixin:
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def get_request(self, method="get", session=None):
+        request = getattr(self.factory, method)("/")
+        if session is None:
+            SessionMiddleware(lambda request: None).process_request(request)
+        else:
+            request.session = session
+        return request
+
+
+@override_settings(
+    CBVHTMX_REPLICA_DATABASE="replica",
+    DATABASE_ROUTERS=["cbvhtmx.replicas.ReplicaRouter"],
+)
+class ReplicaTests(SessionRequestMixin, TestCase):
+    databases = {"default", "replica"}
+
+    def test_reads_use_the_replica(self):
+        queryset = using_read_database(self.get_request(), User.objects.all())
+        self.assertEqual(queryset.db, "replica")
+
+    @override_settings(CBVHTMX_REPLICA_DATABASE=None)
+    def test_reads_use_the_default_routing_without_a_replica(self):
+        queryset = using_read_database(self.get_request(), User.objects.all())
+        self.assertEqual(queryset.db, "default")
+
+    def test_posts_stay_on_the_primary(self):
+        request = self.get_request("post")
+        self.assertIsNone(get_read_database(request))
+        queryset = using_read_database(request, User.objects.all())
+        self.assertEqual(queryset.db, "default")
+
+    def test_explicitly_routed_querysets_are_kept(self):
+        queryset = using_read_database(
+            self.get_request(), User.objects.using("default")
+        )
+        self.assertEqual(queryset.db, "default")
+
+    def test_view_queryset_uses_the_replica(self):
+        view = UserListView()
+        view.setup(self.get_request())
+        self.assertEqual(view.get_queryset().db, "replica")
+
+
+@override_settings(
+    CBVHTMX_REPLICA_DATABASE="replica",
+    DATABASE_ROUTERS=["cbvhtmx.replicas.ReplicaRouter"],
+)
+class ReplicaMiddlewareTests(SessionRequestMixin, TransactionTestCase):
+    # commits the writes, a mirror of an in-memory SQLite database can't read the uncommitted tables of a TestCase
+    databases = {"default", "replica"}
+
+    def test_write_pins_the_session_to_the_primary(self):
+        def write(request):
+            User.objects.create_user("writer")
+            return HttpResponse()
+
+        request = self.get_request("post")
+        ReplicaMiddleware(write)(request)
+        self.assertGreater(request.session[SESSION_KEY], time.time())
+
+        next_request = self.get_request(session=request.session)
+        self.assertIsNone(get_read_database(next_request))
+        queryset = using_read_database(next_request, User.objects.all())
+        self.assertEqual(queryset.db, "default")
+
+    def test_reads_and_session_saves_dont_pin_the_session(self):
+        def read(request):
+            User.objects.count()
+            request.session["seen"] = True
+            request.session.save()
+            return HttpResponse()
+
+        request = self.get_request()
+        ReplicaMiddleware(read)(request)
+        self.assertNotIn(SESSION_KEY, request.session)
+        self.assertEqual(
+            get_read_database(self.get_request(session=request.session)), "replica"
+        )
+
+    @override_settings(CBVHTMX_REPLICA_STICKY_SECONDS=-1)
+    def test_pinning_expires(self):
+        def write(request):
+            User.objects.create_user("writer")
+            return HttpResponse()
+
+        request = self.get_request("post")
+        ReplicaMiddleware(write)(request)
+        self.assertEqual(
+            get_read_database(self.get_request(session=request.session)), "replica"
+        )
+
+
+class ByteRangeTests(TestCase):
+    def test_closed_range(self):
+        self.assertEqual(get_byte_range("bytes=2-4", 10), (2, 4))
+
+    def test_end_is_clamped_to_the_file(self):
+        self.assertEqual(get_byte_range("bytes=2-100", 10), (2, 9))
+
+    def test_open_ended_range(self):
+        self.assertEqual(get_byte_range("bytes=7-", 10), (7, 9))
+
+    def test_suffix_range(self):
+        self.assertEqual(get_byte_range("bytes=-3", 10), (7, 9))
+        self.assertEqual(get_byte_range("bytes=-30", 10), (0, 9))
+
+    def test_unsatisfiable_ranges(self):
+        for range_header, file_size in [
+            ("bytes=10-", 10),
+            ("bytes=12-20", 10),
+            ("bytes=-0", 10),
+            ("bytes=0-", 0),
+            ("bytes=-5", 0),
+        ]:
+            with self.subTest(range_header=range_header, file_size=file_size):
+                with self.assertRaises(ValueError):
+                    get_byte_range(range_header, file_size)
+
+    def test_ignored_ranges(self):
+        for range_header in ["bytes=-", "bytes=5-2", "bytes=0-1,4-5", "items=0-1"]:
+            with self.subTest(range_header=range_header):
+                self.assertIsNone(get_byte_range(range_header, 10))
+
+
+class ExportFileResponseTests(TestCase):
+    def setUp(self):
+        export_file = tempfile.NamedTemporaryFile(delete=False)
+        export_file.write(b"0123456789")
+        export_file.close()
+        self.file_path = export_file.name
+        self.addCleanup(os.remove, self.file_path)
+        self.modified = int(os.stat(self.file_path).st_mtime)
+
+    def get_response(self, **headers):
+        view = ExportMixin()
+        view.request = RequestFactory().get("/", headers=headers)
+        response = view.get_file_response(self.file_path)
+        self.addCleanup(response.close)
+        return response
+
+    def test_whole_file(self):
+        response = self.get_response()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+
+    def test_range(self):
+        response = self.get_response(Range="bytes=2-4")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 2-4/10")
+        self.assertEqual(response["Content-Length"], "3")
+        self.assertEqual(b"".join(response.streaming_content), b"234")
+
+    def test_range_with_matching_if_range(self):
+        response = self.get_response(
+            Range="bytes=-4", **{"If-Range": http_date(self.modified)}
+        )
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), b"6789")
+
+    def test_range_with_stale_if_range(self):
+        response = self.get_response(
+            Range="bytes=2-4", **{"If-Range": http_date(self.modified - 60)}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"0123456789")
+
+    def test_range_with_an_etag_if_range(self):
+        # no ETags are sent, so an entity tag can't match
+        response = self.get_response(Range="bytes=2-4", **{"If-Range": '"abc"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_unsatisfiable_range(self):
+        response = self.get_response(Range="bytes=10-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */10")
+
+
+class QuerySpecTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.rock = Group.objects.create(name="rock")
+        cls.jazz = Group.objects.create(name="jazz")
+        cls.ozzy = User.objects.create(username="ozzy", email="ozzy@sabbath.example")
+        cls.tony = User.objects.create(username="tony", email="tony@sabbath.example")
+        cls.miles = User.objects.create(username="miles", email="miles@blue.example")
+        cls.ozzy.groups.add(cls.rock)
+        cls.tony.groups.add(cls.rock, cls.jazz)
+        cls.miles.groups.add(cls.jazz)
+
+    def search(self, query_spec, query):
+        return set(query_spec.filter_queryset(User.objects.all(), query))
+
+    def test_parse(self):
+        query_spec = QuerySpec(User, ["username", "email"])
+        self.assertEqual(
+            query_spec.parse('ozzy "black sabbath" username:tony  email:"a b" '),
+            [
+                (None, "ozzy"),
+                (None, "black sabbath"),
+                ("username", "tony"),
+                ("email", "a b"),
+            ],
+        )
+
+    def test_parse_unknown_field_is_a_free_word(self):
+        query_spec = QuerySpec(User, ["username"])
+        self.assertEqual(
+            query_spec.parse("00:1a:2b first_name:x"),
+            [(None, "00:1a:2b"), (None, "first_name:x")],
+        )
+
+    def test_free_words_match_any_field_and_all_words(self):
+        query_spec = QuerySpec(User, ["username", "email"])
+        self.assertEqual(self.search(query_spec, "sabbath"), {self.ozzy, self.tony})
+        self.assertEqual(self.search(query_spec, "sabbath TONY"), {self.tony})
+        self.assertEqual(
+            self.search(query_spec, ""), {self.ozzy, self.tony, self.miles}
+        )
+
+    def test_field_tokens_only_match_their_field(self):
+        query_spec = QuerySpec(User, ["username", "email"])
+        self.assertEqual(self.search(query_spec, "username:sabbath"), set())
+        self.assertEqual(self.search(query_spec, "email:blue"), {self.miles})
+
+    def test_typed_fields_and_ranges(self):
+        query_spec = QuerySpec(User, ["username", "id"])
+        self.assertEqual(self.search(query_spec, f"id:{self.tony.pk}"), {self.tony})
+        self.assertEqual(
+            self.search(query_spec, f"id:{self.tony.pk}.."), {self.tony, self.miles}
+        )
+        self.assertEqual(
+            self.search(query_spec, f"id:..{self.tony.pk}"), {self.ozzy, self.tony}
+        )
+
+    def test_token_matching_no_field_finds_nothing(self):
+        query_spec = QuerySpec(User, ["id"])
+        self.assertEqual(query_spec.build_filters("id:abc"), [Q(pk__in=[])])
+        self.assertEqual(self.search(query_spec, "abc"), set())
+
+    def test_to_many_tokens_are_filtered_separately(self):
+        query_spec = QuerySpec(User, ["username", "groups__name__in"])
+        self.assertTrue(query_spec.needs_distinct)
+        self.assertEqual(
+            self.search(query_spec, "groups:rock groups:jazz"), {self.tony}
+        )
+        self.assertEqual(
+            list(query_spec.filter_queryset(User.objects.all(), "groups:rock")),
+            list(User.objects.filter(groups=self.rock)),
+        )
+
+    def test_lookups(self):
+        query_spec = QuerySpec(User, ["username"], query_lookups={"username": "iexact"})
+        self.assertEqual(self.search(query_spec, "OZZY"), {self.ozzy})
+        self.assertEqual(self.search(query_spec, "ozz"), set())
+
+    def test_invalid_query_fields(self):
+        for query_fields, query_lookups in [
+            (["missing"], None),
+            (["groups"], None),
+            (["username"], {"email": "iexact"}),
+            (["username"], {"username": "missing"}),
+            (["groups__name__in"], {"groups__name__in": "exact"}),
+        ]:
+            with self.subTest(query_fields=query_fields, query_lookups=query_lookups):
+                with self.assertRaises(ImproperlyConfigured):
+                    QuerySpec(User, query_fields, query_lookups)
+
+
+class SearchIndexTests(TestCase):
+    query_fields = ["username", "email", "groups__name__in"]
+    queries = [
+        "",
+        "o",
+        "ozzy",
+        "SABBATH",
+        "sabbath tony",
+        "example",
+        "rock",
+        "jazz blue",
+        "nothing",
+        "bat",
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        rock = Group.objects.create(name="rock")
+        jazz = Group.objects.create(name="jazz")
+        cls.ozzy = User.objects.create(username="ozzy", email="ozzy@sabbath.example")
+        cls.tony = User.objects.create(username="tony", email="tony@sabbath.example")
+        cls.miles = User.objects.create(username="miles", email="miles@blue.example")
+        cls.ozzy.groups.add(rock)
+        cls.tony.groups.add(rock, jazz)
+        cls.miles.groups.add(jazz)
+
+    def setUp(self):
+        self.query_spec = QuerySpec(User, self.query_fields)
+        self.search_index = SearchIndex(self.query_spec)
+        dispatch_uid = f"cbvhtmx_search_index_{id(self.search_index)}"
+        for signal in (post_save, post_delete):
+            self.addCleanup(signal.disconnect, sender=User, dispatch_uid=dispatch_uid)
+        self.addCleanup(
+            m2m_changed.disconnect,
+            sender=User.groups.through,
+            dispatch_uid=dispatch_uid,
+        )
+
+    def assertMatchesDatabase(self):
+        for query in self.queries:
+            with self.subTest(query=query):
+                self.assertEqual(
+                    self.search_index.search(query),
+                    set(
+                        self.query_spec.filter_queryset(
+                            User.objects.all(), query
+                        ).values_list("pk", flat=True)
+                    ),
+                )
+
+    def test_search_matches_the_database(self):
+        self.assertMatchesDatabase()
+
+    def test_index_follows_saves_deletes_and_tags(self):
+        self.search_index.build()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ozzy.email = "ozzy@blue.example"
+            self.ozzy.save()
+            self.miles.delete()
+            User.objects.create(username="bat", email="bat@cave.example")
+            self.tony.groups.clear()
+        self.assertMatchesDatabase()
+
+    def test_expired_index_is_rebuilt(self):
+        self.search_index.build()
+        # changed without signals
+        User.objects.filter(pk=self.ozzy.pk).update(username="osbourne")
+        self.assertEqual(self.search_index.search("osbourne"), set())
+        self.search_index.max_age = 0
+        self.search_index.built_at -= 1
+        self.assertMatchesDatabase()
+
+    def test_field_tokens_are_unavailable(self):
+        with self.assertRaises(SearchIndexUnavailable):
+            self.search_index.search("username:ozzy")
+
+    def test_over_budget_is_unavailable(self):
+        search_index = SearchIndex(self.query_spec, memory_budget=0)
+        dispatch_uid = f"cbvhtmx_search_index_{id(search_index)}"
+        for signal in (post_save, post_delete):
+            self.addCleanup(signal.disconnect, sender=User, dispatch_uid=dispatch_uid)
+        with self.assertLogs("cbvhtmx.search_index", "WARNING"):
+            with self.assertRaises(SearchIndexUnavailable):
+                search_index.search("ozzy")
@@ -1,8 +1,19 @@
 # utils/tools.py
+import hashlib
 import logging
+import time
+import uuid
+from contextlib import ExitStack, contextmanager, nullcontext
 from functools import wraps
 
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.template.response import TemplateResponse
+from django.utils.html import format_html
 
 logger = logging.getLogger(__name__)
 
@@ -50,3 +61,224 @@ def value_to_string_or_empty_string(value):
     if value:
         return str(value)
     return ""
+
+
+def get_row_cache_key(row_object, fragment_name, vary_on=()):
+    """
+    Builds the cache key of a row fragment (see the cache_row template tag).
+
+    :param django.db.models.base.Model row_object: the object rendered in the row
+    :param str fragment_name: the name of the fragment, so several tables can cache the same object
+    :param vary_on: values the fragment depends on, e.g. the object's version or updated timestamp
+    :return: str
+    """
+    vary_hash = hashlib.md5(
+        ":".join(str(value) for value in vary_on).encode("utf-8")
+    ).hexdigest()
+    return f"cbvhtmx:row:{row_object._meta.label_lower}:{row_object.pk}:{fragment_name}:{vary_hash}"
+
+
+def get_relation_version_key(model, pk):
+    return f"cbvhtmx:row_relations:{model._meta.label_lower}:{pk}"
+
+
+def bump_relation_versions(model, pks, cache_alias="default"):
+    """
+    Gives objects new relation versions, so their cached rows are rendered again. pk "all" stands for every object.
+    """
+    caches[cache_alias].set_many(
+        {get_relation_version_key(model, pk): uuid.uuid4().hex for pk in pks}, None
+    )
+
+
+def get_relation_versions(model, pks, cache_alias="default"):
+    """
+    Returns the relation versions of objects, combined with the version of the whole model.
+
+    Missing versions (never set or evicted) are set to new values, so an evicted version never brings back a row
+    cached before it was bumped.
+
+    :return: dictionary pk -> str
+    """
+    cache = caches[cache_alias]
+    keys = {get_relation_version_key(model, pk): pk for pk in pks}
+    all_key = get_relation_version_key(model, "all")
+    versions = cache.get_many(list(keys) + [all_key])
+    missing = {
+        key: uuid.uuid4().hex for key in list(keys) + [all_key] if key not in versions
+    }
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return {pk: f"{versions[key]}:{versions[all_key]}" for key, pk in keys.items()}
+
+
+def register_row_cache_relation(model, field_name, cache_alias="default"):
+    """
+    Bumps the relation versions of a model's objects when a many-to-many relation (e.g. their tags) changes.
+
+    Saving or deleting a related object (e.g. renaming a tag) bumps the version of the whole model. Registering a
+    relation twice has no effect.
+    """
+    relation = model._meta.get_field(field_name)
+    related_model = relation.related_model
+    dispatch_uid = f"cbvhtmx_row_cache_{model._meta.label_lower}_{field_name}"
+
+    def handle_m2m(
+        sender, instance, action, reverse, model=None, pk_set=None, **kwargs
+    ):
+        if action not in ("post_add", "post_remove", "post_clear"):
+            return
+        if isinstance(instance, relation.model):
+            pks = [instance.pk]
+        elif isinstance(instance, related_model) and model is relation.model and pk_set:
+            pks = list(pk_set)
+        elif isinstance(instance, related_model) and model is relation.model:
+            # the affected objects are unknown once the relation is cleared
+            pks = ["all"]
+        else:
+            # the through model may be shared with other models (e.g. taggit's TaggedItem)
+            return
+        transaction.on_commit(
+            lambda: bump_relation_versions(relation.model, pks, cache_alias)
+        )
+
+    def handle_related_change(sender, **kwargs):
+        transaction.on_commit(
+            lambda: bump_relation_versions(relation.model, ["all"], cache_alias)
+        )
+
+    m2m_changed.connect(
+        handle_m2m,
+        sender=relation.remote_field.through,
+        dispatch_uid=dispatch_uid,
+        weak=False,
+    )
+    for signal in (post_save, post_delete):
+        signal.connect(
+            handle_related_change,
+            sender=related_model,
+            dispatch_uid=dispatch_uid,
+            weak=False,
+        )
+
+
+def render_row(view, template_name, row_object, row_id, diff_oob=None):
+    """
+    Renders a single list row for an out-of-band swap (see HxDiffMixin and LiveListMixin).
+
+    :param view: the view rendering the row
+    :param str template_name: the row template (context: object, view, row_id, diff_oob)
+    :param django.db.models.base.Model row_object: the object of the row
+    :param str row_id: the id of the row element
+    :param diff_oob: the row's hx-swap-oob value, None when the row isn't swapped by its id
+    :return: str
+    """
+    row_context = {
+        "object": row_object,
+        "view": view,
+        "row_id": row_id,
+        "diff_oob": diff_oob,
+    }
+    return render_to_string(template_name, row_context, request=view.request)
+
+
+def render_deleted_row(row_tag, row_id):
+    """
+    Renders an empty row element deleting the row with the same id out of band.
+    """
+    return format_html(
+        '<{} id="{}" hx-swap-oob="delete"></{}>', row_tag, row_id, row_tag
+    )
+
+
+class CallbackTemplateResponse(TemplateResponse):
+    """
+    A TemplateResponse that runs callbacks once the response has been sent to the client.
+
+    Callbacks run before the response is closed (and before the request_finished signal), so they can still use the
+    request's database connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.close_callbacks = []
+
+    def close(self):
+        for callback in self.close_callbacks:
+            try:
+                callback()
+            except Exception as callback_e:
+                logger.exception(f"Response callback failed: {callback_e}")
+        super().close()
+
+
+class ServerTiming:
+    """
+    Collects durations and database query counts of the phases of a request for the Server-Timing header.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        query_count = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal query_count
+            query_count += 1
+            return execute(sql, params, many, context)
+
+        phase_start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(count_queries))
+                yield
+        finally:
+            duration, queries = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (
+                duration + (time.perf_counter() - phase_start) * 1000,
+                queries + query_count,
+            )
+
+    def get_header(self):
+        entries = [
+            f'{name};dur={duration:.1f};desc="{name} ({queries} queries)"'
+            for name, (duration, queries) in self.phases.items()
+        ]
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_no_timing = nullcontext()
+
+
+def start_server_timing(request):
+    """
+    Attaches a ServerTiming to the request if the setting CBVHTMX_SERVER_TIMING is enabled.
+    """
+    if not getattr(settings, "CBVHTMX_SERVER_TIMING", False):
+        return None
+    if getattr(request, "server_timing", None) is None:
+        request.server_timing = ServerTiming()
+    return request.server_timing
+
+
+def timed_phase(request, name):
+    """
+    Returns a context manager timing a phase of the request (does nothing if timing is disabled).
+    """
+    server_timing = getattr(request, "server_timing", None)
+    if server_timing is None:
+        return _no_timing
+    return server_timing.phase(name)
+
+
+def add_server_timing_header(request, response):
+    server_timing = getattr(request, "server_timing", None)
+    if server_timing is not None and response is not None:
+        response["Server-Timing"] = server_timing.get_header()
+    return response
@@ -1,3 +1,61 @@
-from django.shortcuts import render
+# cbvhtmx\views.py
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.utils.html import format_html_join
+from django.views.generic import View
 
-# Create your views here.
+from .mixins import TagsMixin
+from .tag_index import get_tag_index
+
+
+class TagAutocompleteView(TagsMixin, View):
+    """
+    Suggests tag names of a model for a typed prefix.
+
+    Uses attributes:
+    - model - the tagged model, its tags_field and tag_name_field (see TagsMixin) define the tags
+    - autocomplete_param - the request parameter holding the typed prefix
+    - autocomplete_limit - the maximum number of suggestions
+    - autocomplete_min_length - shorter prefixes get no suggestions
+    - autocomplete_max_age - the seconds after which the index is rebuilt, so tags added by other worker processes
+    show up (None if there is only one process)
+    - autocomplete_template - a template rendering the suggestions (context: suggestions, prefix, view). If None,
+    <option> elements for a <datalist> are rendered
+
+    The suggestions are answered from an in-memory prefix index (see cbvhtmx.tag_index) ranked by usage, e.g.
+    <input list="tag-options" name="q" hx-get="{% url 'tag-autocomplete' %}" hx-trigger="keyup changed delay:150ms"
+    hx-target="#tag-options"><datalist id="tag-options"></datalist>
+    """
+
+    model = None
+    autocomplete_param = "q"
+    autocomplete_limit = 10
+    autocomplete_min_length = 1
+    autocomplete_max_age = 60
+    autocomplete_template = None
+
+    def get_suggestions(self, prefix):
+        if len(prefix.strip()) < self.autocomplete_min_length:
+            return []
+        tag_index = get_tag_index(self.model, self.tags_field, self.tag_name_field)
+        return tag_index.suggest(
+            prefix, self.autocomplete_limit, self.autocomplete_max_age
+        )
+
+    def get(self, request, *args, **kwargs):
+        prefix = request.GET.get(self.autocomplete_param, "")
+        suggestions = self.get_suggestions(prefix)
+
+        if self.autocomplete_template:
+            content = render_to_string(
+                self.autocomplete_template,
+                {"suggestions": suggestions, "prefix": prefix, "view": self},
+                request=request,
+            )
+        else:
+            content = format_html_join(
+                "\n",
+                '<option value="{}">{} ({})</option>',
+                ((name, name, count) for name, count in suggestions),
+            )
+        return HttpResponse(content)
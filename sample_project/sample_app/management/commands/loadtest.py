@@ -0,0 +1,276 @@
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.urls import reverse
+from taggit.models import Tag, TaggedItem
+
+from sample_app.models import Albums
+
+WORDS = [
+    "midnight",
+    "electric",
+    "silver",
+    "velvet",
+    "thunder",
+    "ocean",
+    "neon",
+    "golden",
+    "shadow",
+    "crystal",
+    "paper",
+    "wild",
+    "broken",
+    "summer",
+    "echo",
+    "river",
+    "static",
+    "honey",
+    "iron",
+    "lunar",
+]
+TAGS = [
+    "rock",
+    "jazz",
+    "pop",
+    "metal",
+    "folk",
+    "blues",
+    "punk",
+    "soul",
+    "ambient",
+    "disco",
+]
+
+# the search input sends its request 500ms after the last keyup (hx-trigger="keyup changed delay:500ms")
+SEARCH_DEBOUNCE = 0.5
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays scripted HTMX sessions (search-as-you-type, ordering, deep pagination, exports) against the "
+        "album views in-process and reports throughput, latency and query counts per endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users", type=int, default=10, help="Number of concurrent sessions."
+        )
+        parser.add_argument(
+            "--duration", type=float, default=30, help="Seconds to run."
+        )
+        parser.add_argument(
+            "--rows",
+            type=int,
+            default=10000,
+            help="Seed the database up to this many albums.",
+        )
+        parser.add_argument(
+            "--mix",
+            default="typing=70,ordering=10,paging=15,export=5",
+            help="Weights of the session scripts.",
+        )
+        parser.add_argument(
+            "--seed", type=int, default=None, help="Random seed for reproducible runs."
+        )
+
+    def handle(self, *args, **options):
+        if options["users"] < 1:
+            raise CommandError("--users must be at least 1")
+
+        self.random = random.Random(options["seed"])
+        self.seed_albums(options["rows"])
+
+        scripts = self.parse_mix(options["mix"])
+        self.results = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.last_exception = None
+        self.results_lock = threading.Lock()
+
+        stop_at = time.perf_counter() + options["duration"]
+        workers = [
+            threading.Thread(
+                target=self.run_user,
+                args=(scripts, stop_at, random.Random(self.random.random())),
+            )
+            for _ in range(options["users"])
+        ]
+        self.stdout.write(
+            f"Running {options['users']} sessions for {options['duration']}s "
+            f"against {connection.vendor} ({Albums.objects.count()} albums)..."
+        )
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.print_report(time.perf_counter() - started)
+
+    def parse_mix(self, mix):
+        scripts = {
+            "typing": self.typing_session,
+            "ordering": self.ordering_session,
+            "paging": self.paging_session,
+            "export": self.export_session,
+        }
+        weighted = []
+        for entry in mix.split(","):
+            name, _, weight = entry.partition("=")
+            if name.strip() not in scripts:
+                raise CommandError(
+                    f"Unknown session script '{name}', use one of {', '.join(scripts)}"
+                )
+            weighted.append((scripts[name.strip()], int(weight or 1)))
+        return weighted
+
+    def seed_albums(self, rows):
+        missing = rows - Albums.objects.count()
+        if missing <= 0:
+            return
+        self.stdout.write(f"Seeding {missing} albums...")
+        albums = Albums.objects.bulk_create(
+            [
+                Albums(
+                    album_name=" ".join(self.random.sample(WORDS, 2)).title(),
+                    band_name=f"The {self.random.choice(WORDS).title()}s",
+                )
+                for _ in range(missing)
+            ],
+            batch_size=1000,
+        )
+        if not albums or albums[0].pk is None:
+            # backends without returning ids on bulk insert
+            albums = list(Albums.objects.order_by("-pk")[:missing])
+
+        tags = [Tag.objects.get_or_create(name=name)[0] for name in TAGS]
+        content_type = ContentType.objects.get_for_model(Albums)
+        TaggedItem.objects.bulk_create(
+            [
+                TaggedItem(tag=tag, content_type=content_type, object_id=album.pk)
+                for album in albums
+                for tag in self.random.sample(tags, self.random.randint(0, 3))
+            ],
+            batch_size=1000,
+        )
+
+    def request(self, client, endpoint, url, htmx=False):
+        query_count = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal query_count
+            query_count += 1
+            return execute(sql, params, many, context)
+
+        headers = {"HTTP_HX_REQUEST": "true"} if htmx else {}
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_queries):
+            response = client.get(url, **headers)
+            # streaming responses (exports) are only finished once they are read
+            if response.streaming:
+                b"".join(response.streaming_content)
+        duration = time.perf_counter() - started
+
+        with self.results_lock:
+            if response.status_code >= 400:
+                self.errors[endpoint] += 1
+            else:
+                self.results[endpoint].append((duration, query_count))
+
+    def typing_session(self, client, session_random):
+        list_url = reverse("albums:list")
+        word = session_random.choice(WORDS)
+        for length in range(1, len(word) + 1):
+            # keyups arrive about every 150ms, with an occasional pause
+            if session_random.random() < 0.2:
+                pause = session_random.uniform(0.3, 1.0)
+            else:
+                pause = session_random.uniform(0.05, 0.2)
+            if length < len(word) and pause < SEARCH_DEBOUNCE:
+                # the next keyup restarts the delay, no request is sent
+                time.sleep(pause)
+                continue
+            time.sleep(SEARCH_DEBOUNCE)
+            self.request(
+                client, "search (keyup)", f"{list_url}?q={word[:length]}", htmx=True
+            )
+            if length < len(word):
+                time.sleep(pause - SEARCH_DEBOUNCE)
+
+    def ordering_session(self, client, session_random):
+        list_url = reverse("albums:list")
+        for ordering in ("band_name", "-band_name", "album_name", "-album_name"):
+            self.request(
+                client, "ordering", f"{list_url}?ordering={ordering}", htmx=True
+            )
+            time.sleep(session_random.uniform(0.2, 1.0))
+
+    def paging_session(self, client, session_random):
+        list_url = reverse("albums:list")
+        last_page = max(Albums.objects.count() // 100, 1)
+        for page in sorted(
+            session_random.sample(range(1, last_page + 1), min(5, last_page))
+        ):
+            self.request(client, "pagination", f"{list_url}?page={page}", htmx=True)
+            time.sleep(session_random.uniform(0.2, 1.0))
+
+    def export_session(self, client, session_random):
+        export_url = reverse("albums:export", kwargs={"extension": "csv"})
+        query = session_random.choice(["", f"?q={session_random.choice(WORDS)}"])
+        self.request(client, "export", f"{export_url}{query}")
+
+    def run_user(self, scripts, stop_at, session_random):
+        client = Client(HTTP_HOST="localhost")
+        session_scripts = [script for script, _ in scripts]
+        weights = [weight for _, weight in scripts]
+        try:
+            while time.perf_counter() < stop_at:
+                script = session_random.choices(session_scripts, weights)[0]
+                try:
+                    script(client, session_random)
+                except Exception as session_e:
+                    # the test client re-raises exceptions of the views
+                    with self.results_lock:
+                        self.errors["exceptions"] += 1
+                        self.last_exception = f"{type(session_e).__name__}: {session_e}"
+        finally:
+            connections.close_all()
+
+    def print_report(self, elapsed):
+        header = (
+            f"{'endpoint':<16}{'requests':>9}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+            f"{'queries':>9}{'errors':>8}"
+        )
+        self.stdout.write(self.style.MIGRATE_HEADING(header))
+        total_requests = 0
+        for endpoint in sorted(set(self.results) | set(self.errors)):
+            samples = self.results.get(endpoint, [])
+            durations = sorted(duration * 1000 for duration, _ in samples)
+            total_requests += len(samples)
+            if durations:
+                row = (
+                    f"{len(durations):>9}{len(durations) / elapsed:>8.1f}"
+                    f"{percentile(durations, 0.5):>9.1f}{percentile(durations, 0.95):>9.1f}"
+                    f"{percentile(durations, 0.99):>9.1f}{durations[-1]:>9.1f}"
+                    f"{statistics.mean(queries for _, queries in samples):>9.1f}"
+                )
+            else:
+                row = f"{0:>9}{0:>8.1f}{'-':>9}{'-':>9}{'-':>9}{'-':>9}{'-':>9}"
+            self.stdout.write(f"{endpoint:<16}{row}{self.errors.get(endpoint, 0):>8}")
+        self.stdout.write(
+            f"Total: {total_requests} requests in {elapsed:.1f}s ({total_requests / elapsed:.1f} req/s)"
+        )
+        if self.last_exception:
+            self.stdout.write(
+                self.style.ERROR(f"Last exception: {self.last_exception}")
+            )
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
@@ -0,0 +1,14 @@
+from django.urls import path
+
+from cbvhtmx.views import TagAutocompleteView
+
+from .models import Albums
+from .views import AlbumExportView, AlbumListView
+
+app_name = "albums"
+
+urlpatterns = [
+    path("", AlbumListView.as_view(), name="list"),
+    path("export/<str:extension>/", AlbumExportView.as_view(), name="export"),
+    path("tags/", TagAutocompleteView.as_view(model=Albums), name="tags"),
+]
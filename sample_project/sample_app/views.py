@@ -1,3 +1,47 @@
-from django.shortcuts import render
+from django.views.generic import ListView
 
-# Create your views here.
+from cbvhtmx.mixins import (
+    ExportMixin,
+    FieldQueryMixin,
+    HxMixin,
+    OrderingMixin,
+    TagsMixin,
+)
+from cbvhtmx.services import ExportField
+
+from .models import Albums
+
+
+def parse_tags(album):
+    return ", ".join(tag.name for tag in album.tags.all())
+
+
+class AlbumListView(FieldQueryMixin, HxMixin, OrderingMixin, TagsMixin, ListView):
+    model = Albums
+    ordering = "album_name"
+    ordering_fields = ["album_name", "band_name"]
+    paginate_by = 100
+    template_name = "sample_app/album_list.html"
+    hx_template = "sample_app/htmx/album_rows.html"
+    query_fields = [
+        "album_name",
+        "band_name",
+        "tags__name__in",
+    ]
+
+
+class AlbumExportView(ExportMixin, FieldQueryMixin, OrderingMixin, TagsMixin, ListView):
+    model = Albums
+    ordering = "album_name"
+    ordering_fields = ["album_name", "band_name"]
+    query_fields = [
+        "album_name",
+        "band_name",
+        "tags__name__in",
+    ]
+    file_name = "Albums"
+    export_fields = [
+        ExportField(display_name="Album", model_field="album_name"),
+        ExportField(display_name="Band", model_field="band_name"),
+        ExportField(display_name="Tags", parser_function=parse_tags),
+    ]
@@ -86,6 +86,32 @@ DATABASES = {
     }
 }
 
+# set POSTGRES_DB to run the sample project (e.g. the load test) against a local PostgreSQL server
+if os.environ.get("POSTGRES_DB"):
+    DATABASES["default"] = {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.environ["POSTGRES_DB"],
+        "USER": os.environ.get("POSTGRES_USER", ""),
+        "PASSWORD": os.environ.get("POSTGRES_PASSWORD", ""),
+        "HOST": os.environ.get("POSTGRES_HOST", "localhost"),
+        "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+    }
+
+# the replica alias is a mirror of the default database in tests, set CBVHTMX_REPLICA to send list, search and
+# export reads to a second SQLite database (create it with "manage.py migrate --database replica")
+DATABASES["replica"] = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+if os.environ.get("CBVHTMX_REPLICA"):
+    DATABASES["replica"].update(
+        ENGINE="django.db.backends.sqlite3", NAME=BASE_DIR / "db_replica.sqlite3"
+    )
+    DATABASE_ROUTERS = ["cbvhtmx.replicas.ReplicaRouter"]
+    MIDDLEWARE.insert(
+        MIDDLEWARE.index("django.contrib.sessions.middleware.SessionMiddleware") + 1,
+        "cbvhtmx.replicas.ReplicaMiddleware",
+    )
+    CBVHTMX_REPLICA_DATABASE = "replica"
+    CBVHTMX_REPLICA_STICKY_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators